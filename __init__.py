@@ -1,6 +1,7 @@
 #This file is part of Tryton cashier module. The COPYRIGHT file at the top level of
 #this repository contains the full copyright notices and license terms.
 from trytond.pool import Pool
+from . import ir
 from . import configuration
 from . import cashier
 from . import close
@@ -26,6 +27,7 @@ def register():
         cashier.CashierDiscount,
         cashier.MoneyTypeType,
         close.Close,
+        close.CloseDiscount,
         close.MoneyTerminalMove,
         close.MoneyTerminalMoveType,
         close.MoneyTerminalMoveAmount,
@@ -34,7 +36,13 @@ def register():
         close.ColletedInAdvance,
         close.ColletedInAdvanceApply,
         close.CloseLog,
+        close.SimulatePostStart,
         sale.Sale,
+        sale.SaleLine,
         receipt.Receipt,
         transfer.Transfer,
+        ir.Cron,
         module='cashier', type_='model')
+    Pool.register(
+        close.SimulatePost,
+        module='cashier', type_='wizard')
@@ -1,14 +1,20 @@
 #This file is part of tryton-cashier module. The COPYRIGHT file at the top level of
 #this repository contains the full copyright notices and license terms.
+from trytond import backend
 from trytond.transaction import Transaction
 from trytond.pool import Pool
 from trytond.model import (
     Workflow, ModelView, ModelSQL, fields, Check)
+from trytond.wizard import Wizard, StateView, Button
+from trytond.rpc import RPC
 from trytond.pyson import Eval, If, Not, Or, Bool
 from trytond.i18n import gettext
 from trytond.modules.currency.fields import Monetary
 from trytond.exceptions import UserError
+from trytond.tools import grouped_slice, reduce_ids
 from decimal import Decimal
+from sql import Null, Literal
+from sql.aggregate import Count, Sum
 from trytond.modules.log_action import LogActionMixin, write_log
 
 
@@ -31,6 +37,149 @@ STATES = [
     ('cancel', 'Canceled'),
 ]
 
+POST_PHASES = [
+    (None, ''),
+    ('sales', 'Sales Processed'),
+    ('invoices', 'Invoices Posted'),
+    ('receipt', 'Receipt Posted'),
+    ('transfers', 'Transfers Posted'),
+]
+
+# Totals of the close stored in <name>_cache fields
+_CACHE_AMOUNTS = [
+    'sale_amount',
+    'terminal_amount',
+    'terminal_amount_ignore',
+    'customer_receivable_amount',
+    'customer_payable_amount',
+    'collected_in_advance_amount',
+    'collected_in_advance_apply_amount',
+    'collected_in_advance_apply_amount_ignore',
+    'total_affected',
+    'total_extra',
+    'total_collected',
+    'diff',
+    ]
+# Stored totals summed from the details, the others are derived from them
+_SUBTOTALS = _CACHE_AMOUNTS[:8]
+
+# Sale transition: (sale state, close state) it is requested for
+_SALE_TRANSITIONS = {
+    'draft': ('draft', 'draft'),
+    'quote': ('quotation', 'confirmed'),
+    'cancel': ('cancelled', 'cancel'),
+    }
+
+
+def _related(records, name):
+    '''
+    Return the unique records referenced by name (Many2One or x2Many)
+    on records, keeping the order in which they are found.
+    '''
+    related = {}
+    for record in records:
+        value = getattr(record, name)
+        if not value:
+            continue
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        for rec in value:
+            related.setdefault(rec.id, rec)
+    return list(related.values())
+
+
+def _chunked(records, size):
+    '''
+    Yield records by lists of size, or all records at once if size is not
+    set.
+    '''
+    if not size:
+        yield list(records)
+        return
+    for sub_records in grouped_slice(records, size):
+        yield list(sub_records)
+
+
+def _get_sum_values(records, names, sums, get_currency):
+    '''
+    Return the amount, amount_ignore and amount_total values of the
+    getter of records from sums, a dictionary by id of the affected and
+    ignored sums, rounded to the currency of each record.
+    '''
+    result = {n: {} for n in names}
+    for record in records:
+        currency = get_currency(record)
+        amount, amount_ignore = (currency.round(a) for a in sums[record.id])
+        values = {
+            'amount': amount,
+            'amount_ignore': amount_ignore,
+            'amount_total': amount + amount_ignore,
+            }
+        for name in names:
+            result[name][record.id] = values[name]
+    return result
+
+
+def _order_cache(name):
+    '''
+    Return an order method of the total name using its stored column.
+    '''
+    @classmethod
+    def order(cls, tables):
+        table, _ = tables[None]
+        return [getattr(table, name + '_cache')]
+    return order
+
+
+def _get_close_fields(Model, records, names, path):
+    '''
+    Return the company, currency and close_state getter values of records
+    of Model read from their close with one query, joining the Many2One
+    fields of path from Model to the close.
+    '''
+    cursor = Transaction().connection.cursor()
+
+    table = current = Model.__table__()
+    query = table
+    Current = Model
+    for name in path:
+        Target = Current._fields[name].get_target()
+        target = Target.__table__()
+        query = query.join(target,
+            condition=getattr(current, name) == target.id)
+        current, Current = target, Target
+    columns = {
+        'company': current.company,
+        'currency': current.currency,
+        'close_state': current.state,
+        }
+
+    result = {n: {} for n in names}
+    for sub_ids in grouped_slice([r.id for r in records]):
+        cursor.execute(*query.select(
+                table.id, *[columns[n] for n in names],
+                where=reduce_ids(table.id, sub_ids)))
+        for row in cursor:
+            for name, value in zip(names, row[1:]):
+                result[name][row[0]] = value
+    return result
+
+
+def _prefetch(records, names):
+    '''
+    Browse records as a single list and read names on all of them,
+    so the values are loaded with one query per model and kept in the
+    transaction cache.
+    '''
+    if not records:
+        return []
+    Model = records[0].__class__
+    records = Model.browse(list({r.id: r for r in records}))
+    for record in records:
+        for name in names:
+            getattr(record, name)
+    return records
+
 
 class Close(Workflow, ModelSQL, ModelView):
     "Cashier Close"
@@ -78,7 +227,14 @@ class Close(Workflow, ModelSQL, ModelView):
         ], states=_STATES, depends=_DEPENDS + ['id', 'company'])
     sale_amount = fields.Function(Monetary('Sale amount',
             digits='currency', currency='currency'),
-        'get_sale_amount')
+        'get_amounts', searcher='search_amounts')
+    sale_amount_cache = Monetary('Sale Amount Cache',
+        digits='currency', currency='currency', readonly=True,
+        select=True)
+    sale_count = fields.Function(fields.Integer('Sales Count'),
+        'get_sales_summary')
+    sales_summary = fields.Function(fields.Text('Sales Summary'),
+        'get_sales_summary')
     transfers = fields.One2Many('cash_bank.transfer',
         'cashier_close', 'Transfers',
         states={
@@ -108,28 +264,45 @@ class Close(Workflow, ModelSQL, ModelView):
         }, depends=_DEPENDS)
     terminal_amount = fields.Function(Monetary('Money terminals amount',
             digits='currency', currency='currency'),
-        'get_terminal_amount')
+        'get_amounts', searcher='search_amounts')
+    terminal_amount_cache = Monetary('Money Terminals Amount Cache',
+        digits='currency', currency='currency', readonly=True)
+    terminal_amount_ignore = fields.Function(Monetary(
+            'Money terminals ignored amount',
+            digits='currency', currency='currency'),
+        'get_amounts', searcher='search_amounts')
+    terminal_amount_ignore_cache = Monetary(
+        'Money Terminals Ignored Amount Cache',
+        digits='currency', currency='currency', readonly=True)
     customers_receivable = fields.One2Many(
         'cashier.close.customer_receivable', 'close', 'Customers Receivable',
         states=_STATES, depends=_DEPENDS)
     customer_receivable_amount = fields.Function(Monetary(
             'Customers Receivable amount',
             digits='currency', currency='currency'),
-        'get_customer_receivable_amount')
+        'get_amounts', searcher='search_amounts')
+    customer_receivable_amount_cache = Monetary(
+        'Customers Receivable Amount Cache',
+        digits='currency', currency='currency', readonly=True)
     customers_payable = fields.One2Many(
         'cashier.close.customer_payable', 'close', 'Customers Payable',
         states=_STATES, depends=_DEPENDS)
     customer_payable_amount = fields.Function(Monetary(
             'Customers Payable amount',
             digits='currency', currency='currency'),
-        'get_customer_payable_amount')
+        'get_amounts', searcher='search_amounts')
+    customer_payable_amount_cache = Monetary('Customers Payable Amount Cache',
+        digits='currency', currency='currency', readonly=True)
     collected_in_advance = fields.One2Many(
         'cashier.close.advance', 'close', 'Collected in Advance',
         states=_STATES, depends=_DEPENDS)
     collected_in_advance_amount = fields.Function(Monetary(
             'Collected in Advance amount',
             digits='currency', currency='currency'),
-        'get_collected_in_advance_amount')
+        'get_amounts', searcher='search_amounts')
+    collected_in_advance_amount_cache = Monetary(
+        'Collected in Advance Amount Cache',
+        digits='currency', currency='currency', readonly=True)
     collected_in_advance_apply = fields.One2Many(
         'cashier.close.advance.apply', 'close',
         'Collected in Advance Applied',
@@ -137,25 +310,57 @@ class Close(Workflow, ModelSQL, ModelView):
     collected_in_advance_apply_amount = fields.Function(Monetary(
             'Collected in Advance Applied amount',
             digits='currency', currency='currency'),
-        'get_collected_in_advance_apply_amount')
+        'get_amounts', searcher='search_amounts')
+    collected_in_advance_apply_amount_cache = Monetary(
+        'Collected in Advance Applied Amount Cache',
+        digits='currency', currency='currency', readonly=True)
+    collected_in_advance_apply_amount_ignore = fields.Function(Monetary(
+            'Collected in Advance Applied ignored amount',
+            digits='currency', currency='currency'),
+        'get_amounts', searcher='search_amounts')
+    collected_in_advance_apply_amount_ignore_cache = Monetary(
+        'Collected in Advance Applied Ignored Amount Cache',
+        digits='currency', currency='currency', readonly=True)
     diff = fields.Function(Monetary('Diff',
             digits='currency', currency='currency'),
-        'get_diff')
-    diff_cache = Monetary(
-        'Diff Cache', digits='currency', currency='currency',
-        readonly=True)
+        'get_amounts', searcher='search_amounts')
+    diff_cache = Monetary('Diff Cache',
+        digits='currency', currency='currency', readonly=True,
+        select=True)
     total_affected = fields.Function(Monetary('Total Affected',
             digits='currency', currency='currency'),
-        'get_total_affected')
+        'get_amounts', searcher='search_amounts')
+    total_affected_cache = Monetary('Total Affected Cache',
+        digits='currency', currency='currency', readonly=True)
     total_extra = fields.Function(Monetary('Total Extra',
             digits='currency', currency='currency'),
-        'get_total_extra')
+        'get_amounts', searcher='search_amounts')
+    total_extra_cache = Monetary('Total Extra Cache',
+        digits='currency', currency='currency', readonly=True)
     total_collected = fields.Function(Monetary('Total Collected',
             digits='currency', currency='currency'),
-        'get_total_collected')
+        'get_amounts', searcher='search_amounts')
+    total_collected_cache = Monetary('Total Collected Cache',
+        digits='currency', currency='currency', readonly=True,
+        select=True)
     note = fields.Text('Notes', size=None)
     cash_bank_receipt = fields.Many2One('cash_bank.receipt',
         'Receipt', readonly=True)
+    netted_transfers = fields.Function(fields.Many2Many(
+            'cash_bank.transfer', None, None, 'Netted Transfers',
+            help='Transfers of the terminals of the close netted with '
+            'those of other closes. They are linked to the first of '
+            'these closes only, and to all their terminal moves.'),
+        'get_netted_transfers')
+    discount_lines = fields.One2Many('cashier.close.discount', 'close',
+        'Discounts', readonly=True)
+    post_phase = fields.Selection(POST_PHASES, 'Post Phase', readonly=True,
+        help='Last phase of the posting that has been completed.')
+    posting = fields.Boolean('Posting', readonly=True,
+        help='The close is waiting to be posted in background.')
+    post_progress = fields.Function(fields.Float('Post Progress',
+            digits=(1, 2)),
+        'get_post_progress')
     logs = fields.One2Many('cashier.close.log_action', 'resource', 'Logs',
         readonly=True)
 
@@ -175,20 +380,28 @@ class Close(Workflow, ModelSQL, ModelView):
 
         cls._buttons.update({
             'cancel': {
-                'invisible': ~Eval('state').in_(['confirmed']),
+                'invisible': (~Eval('state').in_(['confirmed'])
+                    | Eval('posting', False) | Eval('post_phase')),
                 },
             'confirm': {
                 'invisible': ~Eval('state').in_(['draft']),
                 },
             'post': {
-                'invisible': ~Eval('state').in_(['confirmed']),
+                'invisible': (~Eval('state').in_(['confirmed'])
+                    | Eval('posting', False)),
                 },
             'draft': {
                 'invisible': ~Eval('state').in_(['cancel']),
                 'icon': If(Eval('state') == 'cancel',
                     'tryton-clear', 'tryton-go-previous'),
                 },
+            'simulate': {
+                'invisible': ~Eval('state').in_(['draft', 'confirmed']),
+                },
             })
+        cls.__rpc__.update({
+                'simulate_post': RPC(readonly=True, instantiate=0),
+                })
 
     @staticmethod
     def default_company():
@@ -206,49 +419,76 @@ class Close(Workflow, ModelSQL, ModelView):
             company = Company(company)
             return company.currency.id
 
-    @fields.depends('sales',
-        'terminals', 'customers_receivable',
-        'customers_payable', 'collected_in_advance',
-        'collected_in_advance_apply')
-    def _get_amounts(self):
-        self.sale_amount = self.get_sale_amount()
-        self.terminal_amount = self.get_terminal_amount()
-        self.customer_receivable_amount = \
-            self.get_customer_receivable_amount()
-        self.customer_payable_amount = \
-            self.get_customer_payable_amount()
-        self.collected_in_advance_amount = \
-            self.get_collected_in_advance_amount()
-        self.collected_in_advance_apply_amount = \
-            self.get_collected_in_advance_apply_amount()
+    @fields.depends('sale_amount', 'terminal_amount',
+        'terminal_amount_ignore', 'customer_receivable_amount',
+        'customer_payable_amount', 'collected_in_advance_amount',
+        'collected_in_advance_apply_amount',
+        'collected_in_advance_apply_amount_ignore')
+    def _update_totals(self):
+        '''
+        Update the totals derived from the subtotals of the close.
+        '''
         self.total_affected = self.get_total_affected()
-        self.total_extra = self.get_total_extra()
+        self.total_extra = (
+            self._get_amount_or_zero(self.terminal_amount_ignore) +
+            self._get_amount_or_zero(
+                self.collected_in_advance_apply_amount_ignore))
         self.total_collected = self.get_total_collected()
         self.diff = self.get_diff()
 
-    @fields.depends(methods=['_get_amounts'])
+    @fields.depends('sales', methods=['_update_totals'])
     def on_change_sales(self):
-        self._get_amounts()
-
-    @fields.depends(methods=['_get_amounts'])
+        # Only the ids of the saved sales are used, their amounts are read
+        # on the server in one query. The sales created in the form are
+        # added with the total sent by the client.
+        summary = self._get_sales_summary(
+            sale_ids=[s.id for s in self.sales if s.id and s.id >= 0])
+        summary = summary.get(None, {})
+        for sale in self.sales:
+            if sale.id is not None and sale.id >= 0:
+                continue
+            state = getattr(sale, 'state', None) or 'draft'
+            count, amount = summary.get(state, (0, Decimal('0.0')))
+            summary[state] = (count + 1,
+                amount + (getattr(sale, 'total_amount', None)
+                    or Decimal('0.0')))
+        self.sale_count = self._get_sale_count(summary)
+        self.sales_summary = self._format_sales_summary(summary)
+        self.sale_amount = sum((a for _, a in summary.values()),
+            Decimal('0.0'))
+        self._update_totals()
+
+    @fields.depends('terminals', methods=['_update_totals'])
     def on_change_terminals(self):
-        self._get_amounts()
+        self.terminal_amount = self.get_terminal_amount()
+        self.terminal_amount_ignore = self._get_amount(
+            self.terminals, 'amount_ignore')
+        self._update_totals()
 
-    @fields.depends(methods=['_get_amounts'])
+    @fields.depends('customers_receivable', methods=['_update_totals'])
     def on_change_customers_receivable(self):
-        self._get_amounts()
+        self.customer_receivable_amount = \
+            self.get_customer_receivable_amount()
+        self._update_totals()
 
-    @fields.depends(methods=['_get_amounts'])
+    @fields.depends('customers_payable', methods=['_update_totals'])
     def on_change_customers_payable(self):
-        self._get_amounts()
+        self.customer_payable_amount = self.get_customer_payable_amount()
+        self._update_totals()
 
-    @fields.depends(methods=['_get_amounts'])
+    @fields.depends('collected_in_advance', methods=['_update_totals'])
     def on_change_collected_in_advance(self):
-        self._get_amounts()
+        self.collected_in_advance_amount = \
+            self.get_collected_in_advance_amount()
+        self._update_totals()
 
-    @fields.depends(methods=['_get_amounts'])
+    @fields.depends('collected_in_advance_apply', methods=['_update_totals'])
     def on_change_collected_in_advance_apply(self):
-        self._get_amounts()
+        self.collected_in_advance_apply_amount = \
+            self.get_collected_in_advance_apply_amount()
+        self.collected_in_advance_apply_amount_ignore = self._get_amount(
+            self.collected_in_advance_apply, 'amount_apply_ignore')
+        self._update_totals()
 
     def _get_amount(self, field, name='amount'):
         res = Decimal('0.0')
@@ -259,10 +499,6 @@ class Close(Workflow, ModelSQL, ModelView):
                     res += amount
         return res
 
-    @fields.depends('sales')
-    def get_sale_amount(self, name=None):
-        return self._get_amount(self.sales, 'total_amount')
-
     @fields.depends('terminals')
     def get_terminal_amount(self, name=None):
         return self._get_amount(self.terminals)
@@ -306,19 +542,415 @@ class Close(Workflow, ModelSQL, ModelView):
             )
         return res
 
-    @fields.depends('terminals', 'collected_in_advance_apply')
-    def get_total_extra(self, name=None):
-        res = self._get_amount(self.terminals,
-                'amount_ignore')
-        res += self._get_amount(self.collected_in_advance_apply,
-                'amount_apply_ignore')
-        return res
-
     @fields.depends('total_affected', 'total_extra')
     def get_total_collected(self, name=None):
         return self._get_amount_or_zero(self.total_affected) + \
                 self._get_amount_or_zero(self.total_extra)
 
+    @classmethod
+    def _get_sum_amounts(cls, closes, names=None):
+        '''
+        Return a dictionary by name of dictionaries by close id with the
+        amounts of the details of closes, summed with one GROUP BY query
+        by detail table.
+        The ignored amounts of the terminals and of the advances applied
+        are in terminal_amount_ignore and
+        collected_in_advance_apply_amount_ignore.
+        If names is set, only the tables of these subtotals are queried.
+        '''
+        pool = Pool()
+        Receivable = pool.get('cashier.close.customer_receivable')
+        Payable = pool.get('cashier.close.customer_payable')
+        Advance = pool.get('cashier.close.advance')
+        AdvanceApply = pool.get('cashier.close.advance.apply')
+        MoveAmount = pool.get('cashier.close.terminal.move.amount')
+        cursor = Transaction().connection.cursor()
+
+        if names is None:
+            names = _SUBTOTALS
+        res = {n: {c.id: Decimal('0.0') for c in closes} for n in names}
+
+        def add(name, close_id, amount):
+            if amount is None or name not in res:
+                return
+            if not isinstance(amount, Decimal):
+                amount = Decimal(str(amount))
+            res[name][close_id] += amount
+
+        for sub_closes in grouped_slice(closes):
+            sub_ids = [c.id for c in sub_closes]
+
+            if 'sale_amount' in res:
+                for close_id, summary in cls._get_sales_summary(
+                        sub_ids).items():
+                    for count, amount in summary.values():
+                        add('sale_amount', close_id, amount)
+
+            for name, Model, column in [
+                    ('customer_receivable_amount', Receivable, 'amount_rp'),
+                    ('customer_payable_amount', Payable, 'amount_rp'),
+                    ('collected_in_advance_amount', Advance,
+                        'amount_collected'),
+                    ]:
+                if name not in res:
+                    continue
+                table = Model.__table__()
+                cursor.execute(*table.select(
+                        table.close, Sum(getattr(table, column)),
+                        where=reduce_ids(table.close, sub_ids),
+                        group_by=table.close))
+                for close_id, amount in cursor:
+                    add(name, close_id, amount)
+
+            if {'collected_in_advance_apply_amount',
+                    'collected_in_advance_apply_amount_ignore'} & set(res):
+                apply = AdvanceApply.__table__()
+                cursor.execute(*apply.select(
+                        apply.close, apply.affect_close_total,
+                        Sum(apply.amount_apply),
+                        where=reduce_ids(apply.close, sub_ids),
+                        group_by=[apply.close, apply.affect_close_total]))
+                for close_id, affect, amount in cursor:
+                    name = 'collected_in_advance_apply_amount'
+                    if not affect:
+                        name += '_ignore'
+                    add(name, close_id, amount)
+
+            if {'terminal_amount', 'terminal_amount_ignore'} & set(res):
+                for close_id, (amount, amount_ignore) in (
+                        MoveAmount.get_sums('close', sub_ids).items()):
+                    add('terminal_amount', close_id, amount)
+                    add('terminal_amount_ignore', close_id, amount_ignore)
+
+        for close in closes:
+            for name in names:
+                res[name][close.id] = close.currency.round(
+                    res[name][close.id])
+        return res
+
+    @classmethod
+    def _get_sales_summary(cls, close_ids=None, sale_ids=None,
+            compute=True):
+        '''
+        Return a dictionary by close id of dictionaries by sale state with
+        the count and the total amount of the sales.
+        The sales are those of close_ids or, grouped under None, the
+        sales of sale_ids.
+        The amounts are summed in SQL from the stored total of the sales
+        and only computed for the sales without it. If compute is not set,
+        the sales without it are only counted and the amount of their
+        state is None.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().connection.cursor()
+        sale = Sale.__table__()
+
+        if close_ids is not None:
+            ids, column = close_ids, sale.cashier_close
+        else:
+            ids, column = sale_ids, sale.id
+
+        res = {}
+
+        def add(close_id, state, count, amount):
+            if close_ids is None:
+                close_id = None
+            summary = res.setdefault(close_id, {})
+            s_count, s_amount = summary.get(state, (0, Decimal('0.0')))
+            if s_amount is not None and amount is not None:
+                amount += s_amount
+            else:
+                amount = None
+            summary[state] = (s_count + count, amount)
+
+        missing = []
+        for sub_ids in grouped_slice(ids):
+            where = reduce_ids(column, sub_ids)
+            cursor.execute(*sale.select(
+                    sale.cashier_close, sale.state, sale.currency,
+                    Count(Literal('*')), Sum(sale.total_amount_cache),
+                    where=where & (sale.total_amount_cache != Null),
+                    group_by=[sale.cashier_close, sale.state,
+                        sale.currency]))
+            for close_id, state, currency, count, amount in cursor:
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                add(close_id, state, count, Currency(currency).round(amount))
+            if not compute:
+                cursor.execute(*sale.select(
+                        sale.cashier_close, sale.state, Count(Literal('*')),
+                        where=where & (sale.total_amount_cache == Null),
+                        group_by=[sale.cashier_close, sale.state]))
+                for close_id, state, count in cursor:
+                    add(close_id, state, count, None)
+                continue
+            cursor.execute(*sale.select(sale.id,
+                    where=where & (sale.total_amount_cache == Null)))
+            missing += [i for i, in cursor]
+
+        for values in Sale.read(missing,
+                ['cashier_close', 'state', 'total_amount']):
+            add(values['cashier_close'], values['state'], 1,
+                values['total_amount'] or Decimal('0.0'))
+        return res
+
+    @classmethod
+    def _get_sale_count(cls, summary):
+        return sum(c for c, _ in summary.values())
+
+    @classmethod
+    def _format_sales_summary(cls, summary):
+        '''
+        Return the text of the sales summary, a dictionary by state with
+        the count and the total amount of the sales.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        states = dict(Sale.fields_get(['state'])['state']['selection'])
+        lines = []
+        for state, (count, amount) in sorted(summary.items()):
+            line = '%s: %s' % (states.get(state, state), count)
+            if amount is not None:
+                line += ' (%s)' % amount
+            lines.append(line)
+        return '\n'.join(lines)
+
+    @classmethod
+    def get_sales_summary(cls, closes, names):
+        # The sales without stored total, like the draft ones, are only
+        # counted as their total is in the stored sale amount of the close
+        summaries = {}
+        for sub_closes in grouped_slice(closes):
+            summaries.update(cls._get_sales_summary(
+                    close_ids=[c.id for c in sub_closes], compute=False))
+        result = {n: {} for n in names}
+        for close in closes:
+            summary = summaries.get(close.id, {})
+            if 'sale_count' in names:
+                result['sale_count'][close.id] = cls._get_sale_count(summary)
+            if 'sales_summary' in names:
+                result['sales_summary'][close.id] = (
+                    cls._format_sales_summary(summary))
+        return result
+
+    @classmethod
+    def _get_totals(cls, values):
+        '''
+        Return values, a dictionary with the subtotals of a close, updated
+        with the totals derived from them.
+        '''
+        total_affected = (
+                values['terminal_amount'] +
+                values['customer_receivable_amount'] +
+                values['collected_in_advance_apply_amount']
+            ) - (
+                values['customer_payable_amount'] +
+                values['collected_in_advance_amount']
+            )
+        total_extra = (values['terminal_amount_ignore']
+            + values['collected_in_advance_apply_amount_ignore'])
+        values.update({
+                'total_affected': total_affected,
+                'total_extra': total_extra,
+                'total_collected': total_affected + total_extra,
+                'diff': values['sale_amount'] - total_affected,
+                })
+        return values
+
+    @classmethod
+    def _get_computed_amounts(cls, closes, names=None):
+        '''
+        Return a dictionary by close id with the totals of the close
+        computed from its details.
+        If names is set, only these subtotals are computed and the others
+        are taken from the stored ones.
+        '''
+        stored = []
+        if names is not None:
+            others = [n for n in _SUBTOTALS if n not in names]
+            stored = [c for c in closes
+                if all(getattr(c, n + '_cache') is not None for n in others)]
+        stored_ids = {c.id for c in stored}
+        to_compute = [c for c in closes if c.id not in stored_ids]
+
+        res = {}
+        sums = cls._get_sum_amounts(to_compute)
+        for close in to_compute:
+            res[close.id] = cls._get_totals(
+                {n: sums[n][close.id] for n in sums})
+        sums = cls._get_sum_amounts(stored, names)
+        for close in stored:
+            values = {n: getattr(close, n + '_cache') for n in others}
+            values.update({n: sums[n][close.id] for n in sums})
+            res[close.id] = cls._get_totals(values)
+        return res
+
+    @classmethod
+    def get_amounts(cls, closes, names):
+        '''
+        Return the totals from the stored cache, computing them only for
+        the closes without it.
+        '''
+        result = {n: {} for n in names}
+        to_compute = []
+        for close in closes:
+            values = {n: getattr(close, n + '_cache') for n in names}
+            if None in values.values():
+                to_compute.append(close)
+                continue
+            for name in names:
+                result[name][close.id] = values[name]
+        computed = cls._get_computed_amounts(to_compute)
+        for close in to_compute:
+            for name in names:
+                result[name][close.id] = computed[close.id][name]
+        return result
+
+    @classmethod
+    def search_amounts(cls, name, clause):
+        return [(name + '_cache',) + tuple(clause[1:])]
+
+    order_sale_amount = _order_cache('sale_amount')
+    order_terminal_amount = _order_cache('terminal_amount')
+    order_terminal_amount_ignore = _order_cache('terminal_amount_ignore')
+    order_customer_receivable_amount = _order_cache(
+        'customer_receivable_amount')
+    order_customer_payable_amount = _order_cache('customer_payable_amount')
+    order_collected_in_advance_amount = _order_cache(
+        'collected_in_advance_amount')
+    order_collected_in_advance_apply_amount = _order_cache(
+        'collected_in_advance_apply_amount')
+    order_collected_in_advance_apply_amount_ignore = _order_cache(
+        'collected_in_advance_apply_amount_ignore')
+    order_total_affected = _order_cache('total_affected')
+    order_total_extra = _order_cache('total_extra')
+    order_total_collected = _order_cache('total_collected')
+    order_diff = _order_cache('diff')
+
+    @classmethod
+    def store_cache(cls, closes, names=None):
+        '''
+        Compute and store the totals of closes, only computing the
+        subtotals of names if it is set.
+        The totals are stored without access check as they follow changes
+        made by users who may not write closes, like on their sales.
+        '''
+        with Transaction().set_context(_check_access=False):
+            computed = cls._get_computed_amounts(closes, names)
+            to_write = []
+            for close in closes:
+                values = computed[close.id]
+                to_write.extend(([close], {
+                            n + '_cache': values[n] for n in _CACHE_AMOUNTS}))
+            if to_write:
+                cls.write(*to_write)
+
+    @classmethod
+    def update_cache(cls, closes, names):
+        '''
+        Store again the totals of closes after the details of the subtotals
+        names changed.
+        Closes being deleted or without stored totals are skipped, the
+        latter are computed when read until create or the backfill
+        stores them.
+        '''
+        deleted = Transaction().delete_records.get(cls.__name__, set())
+        closes = [c for c in cls.browse(list({c.id for c in closes
+                        if c and c.id not in deleted}))
+            if c.diff_cache is not None]
+        cls.store_cache(closes, names)
+
+    @classmethod
+    def _get_sale_amounts(cls, sales):
+        '''
+        Return a dictionary by sale id with the close id and the total
+        amount of the sales of sales linked to a close.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        ids = [v['id'] for v in Sale.read(list({s.id for s in sales}),
+                ['cashier_close']) if v['cashier_close'] is not None]
+        return {v['id']: (v['cashier_close'],
+                v['total_amount'] or Decimal('0.0'))
+            for v in Sale.read(ids, ['cashier_close', 'total_amount'])}
+
+    @classmethod
+    def update_sale_cache(cls, before, after):
+        '''
+        Update the stored totals of the closes with the difference of
+        the amounts of their sales from before to after, dictionaries
+        returned by _get_sale_amounts.
+        Only the changed sales are read instead of all the sales of the
+        closes.
+        '''
+        deltas = {}
+        for amounts, sign in [(before, -1), (after, 1)]:
+            for close_id, amount in amounts.values():
+                deltas[close_id] = (
+                    deltas.get(close_id, Decimal('0.0')) + sign * amount)
+        deleted = Transaction().delete_records.get(cls.__name__, set())
+        closes = cls.browse([i for i, d in deltas.items()
+                if d and i not in deleted])
+
+        to_write = []
+        for close in closes:
+            values = {n: getattr(close, n + '_cache') for n in _SUBTOTALS}
+            if None in values.values():
+                continue
+            values['sale_amount'] = close.currency.round(
+                values['sale_amount'] + deltas[close.id])
+            values = cls._get_totals(values)
+            to_write.extend(([close], {
+                        n + '_cache': values[n] for n in _CACHE_AMOUNTS}))
+        if to_write:
+            with Transaction().set_context(_check_access=False):
+                cls.write(*to_write)
+
+    @classmethod
+    def backfill_cache(cls):
+        '''
+        Store the totals of the closes without them, by chunks of the
+        post chunk size committed one by one.
+        '''
+        pool = Pool()
+        Config = pool.get('cashier.configuration')
+
+        config = Config(1)
+        transaction = Transaction()
+        closes = cls.search(['OR'] + [
+                (n + '_cache', '=', None) for n in _CACHE_AMOUNTS],
+            order=[('id', 'ASC')])
+        for sub_closes in grouped_slice(
+                closes, config.post_chunk_size or None):
+            cls.store_cache(cls.browse(sub_closes))
+            transaction.commit()
+
+    @classmethod
+    def get_netted_transfers(cls, closes, name):
+        pool = Pool()
+        Move = pool.get('cashier.close.terminal.move')
+        cursor = Transaction().connection.cursor()
+        move = Move.__table__()
+
+        res = {c.id: [] for c in closes}
+        for sub_ids in grouped_slice([c.id for c in closes]):
+            cursor.execute(*move.select(move.close, move.transfer,
+                    where=reduce_ids(move.close, sub_ids)
+                    & (move.transfer != Null),
+                    group_by=[move.close, move.transfer]))
+            for close_id, transfer_id in cursor:
+                res[close_id].append(transfer_id)
+        return res
+
+    def get_post_progress(self, name):
+        if self.state == 'posted':
+            return 1.0
+        phases = [p for p, _ in POST_PHASES]
+        return phases.index(self.post_phase) / (len(phases) - 1)
+
     def get_rec_name(self, name):
         if self.number:
             return self.number
@@ -333,19 +965,41 @@ class Close(Workflow, ModelSQL, ModelView):
         pool = Pool()
         Config = pool.get('cashier.configuration')
         config = Config(1)
+        to_write = []
         for close in closes:
             if close.number:
                 continue
-            close.number = config.get_multivalue(
-                'close_seq', company=close.company.id).get()
-        cls.save(closes)
+            to_write.extend(([close], {
+                        'number': config.get_multivalue(
+                            'close_seq', company=close.company.id).get(),
+                        }))
+        if to_write:
+            cls.write(*to_write)
 
     @classmethod
     def create(cls, vlist):
         closes = super(Close, cls).create(vlist)
+        cls.store_cache(closes)
         write_log('Created', closes)
         return closes
 
+    @staticmethod
+    def default_posting():
+        return False
+
+    @classmethod
+    def copy(cls, closes, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('post_phase', None)
+        default.setdefault('posting', False)
+        default.setdefault('discount_lines', None)
+        for name in _CACHE_AMOUNTS:
+            default.setdefault(name + '_cache', None)
+        return super(Close, cls).copy(closes, default=default)
+
     @classmethod
     def delete(cls, closes):
         for close in closes:
@@ -357,11 +1011,92 @@ class Close(Workflow, ModelSQL, ModelView):
                     ))
         super(Close, cls).delete(closes)
 
+    @classmethod
+    def _post_prefetch_sales(cls, sales):
+        '''
+        Read the sales and invoices needed to post with one query per model.
+        '''
+        sales = _prefetch(sales, [
+                'state', 'sale_date', 'invoice_method', 'shipment_method',
+                'invoices', 'shipments'])
+        invoices = _prefetch(_related(sales, 'invoices'), [
+                'state', 'account', 'party'])
+        _prefetch(_related(invoices, 'account'), ['name'])
+        _prefetch(_related(invoices, 'party'), ['name'])
+
+    @classmethod
+    def _post_prefetch(cls, closes):
+        '''
+        Read all the records needed to post the closes with one query
+        per model, before the receipt and transfer lines are built.
+        The sales are read by _post_prefetch_sales.
+        '''
+        closes = _prefetch(closes, [
+                'cashier', 'company', 'currency', 'date', 'sales',
+                'terminals', 'customers_receivable', 'customers_payable',
+                'collected_in_advance', 'collected_in_advance_apply'])
+        _prefetch(_related(closes, 'cashier'), [
+                'name', 'cash_bank_cash', 'receipt_type_cash',
+                'receipt_type_cash_out'])
+
+        moves = _prefetch(_related(closes, 'terminals'), [
+                'terminal', 'types'])
+        _prefetch(_related(moves, 'terminal'), [
+                'name', 'group', 'cash_bank', 'receipt_type'])
+        move_types = _prefetch(_related(moves, 'types'), [
+                'move', 'type', 'amounts', 'party', 'date', 'reference',
+                'entity', 'document', 'discount_lines'])
+        move_amounts = _prefetch(_related(move_types, 'amounts'), [
+                'type', 'amount_type', 'amount'])
+        money_types = _prefetch(_related(move_types, 'type'), [
+                'type', 'is_document', 'cash_bank_document', 'discounts'])
+        _prefetch(_related(money_types, 'type'), ['name'])
+        amount_types = _prefetch(_related(move_amounts, 'amount_type'), [
+                'name', 'affect_close_total', 'account_alternate',
+                'discounts'])
+
+        accounts = []
+        for discount_model in (money_types, amount_types):
+            discounts = _prefetch(_related(discount_model, 'discounts'), [
+                    'discount', 'account', 'charges'])
+            charges = _prefetch(_related(discounts, 'charges'), [
+                    'charge', 'account'])
+            _prefetch(_related(discounts, 'discount')
+                + _related(charges, 'charge'), ['name', 'type', 'amount'])
+            accounts += _related(discounts, 'account')
+            accounts += _related(charges, 'account')
+
+        parties = _related(move_types, 'party')
+        accounts += _related(amount_types, 'account_alternate')
+        for name, fnames in [
+                ('customers_receivable', ['account', 'amount_rp']),
+                ('customers_payable', ['account', 'amount_rp']),
+                ('collected_in_advance', [
+                        'account', 'amount_collected', 'advance_origin']),
+                ('collected_in_advance_apply', [
+                        'amount_apply', 'affect_close_total',
+                        'account_alternate', 'advance']),
+                ]:
+            details = _prefetch(_related(closes, name),
+                ['party', 'description'] + fnames)
+            if 'account' in fnames:
+                accounts += _related(details, 'account')
+            parties += _related(details, 'party')
+        accounts += _related(details, 'account_alternate')
+        advances = _prefetch(_related(details, 'advance'), ['receipt_line'])
+        _prefetch(_related(advances, 'receipt_line'), ['account'])
+
+        _prefetch(accounts, ['name'])
+        _prefetch(parties, ['name'])
+
     @classmethod
     def _sales_to_invoice(cls, sales):
-        Invoice = Pool().get('account.invoice')
-        Shipment = Pool().get('stock.shipment.out')
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Shipment = pool.get('stock.shipment.out')
+        shipments = []
         invoices = []
+        dates = {}
         for sale in sales:
             if sale.invoice_method != 'order' or \
                     sale.shipment_method != 'order':
@@ -376,19 +1111,120 @@ class Close(Workflow, ModelSQL, ModelView):
                         continue
                     if ship.state != 'waiting':
                         continue
-                    Shipment.assign([ship,])
-                    Shipment.pack([ship,])
-                    Shipment.done([ship,])
+                    shipments.append(ship)
 
             for inv in sale.invoices:
                 if inv.state == 'draft':
-                    inv.invoice_date = sale.sale_date
-                    inv.save()
+                    dates.setdefault(sale.sale_date, []).append(inv)
                     invoices.append(inv)
 
+        if shipments:
+            Shipment.assign(shipments)
+            Shipment.pack(shipments)
+            Shipment.done(shipments)
+
         if invoices:
+            to_write = []
+            for date, date_invoices in dates.items():
+                to_write.extend((date_invoices, {
+                            'invoice_date': date,
+                            }))
+            Invoice.write(*to_write)
             Invoice.post(invoices)
 
+    @classmethod
+    def _post_sales(cls, sales):
+        '''
+        Confirm and process sales before posting.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        # The quotation may still be waiting in the queue
+        Sale.quote([s for s in sales if s.state == 'draft'])
+        Sale.confirm(sales)
+        Sale.process(sales)
+
+    @classmethod
+    def _post_invoices(cls, sales):
+        '''
+        Ship and invoice the processed sales before posting.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        with Transaction().set_context(_skip_warnings=True):
+            # Evita la advertencia de pago anterior a la fecha
+            # de la factura cuando se aplica pagos por adelantado.
+            cls._sales_to_invoice(Sale.browse(sales))
+
+    @classmethod
+    def _post_todo(cls, closes, phase):
+        '''
+        Return the closes that have not completed phase of the posting.
+        '''
+        phases = [p for p, _ in POST_PHASES]
+        index = phases.index(phase)
+        return [c for c in closes if phases.index(c.post_phase) < index]
+
+    @classmethod
+    def _post_checkpoint(cls, closes, phase, locked=None):
+        '''
+        Record that closes completed phase of the posting.
+        If configured, the transaction is committed so a later failure
+        resumes the posting from the next phase. The commit releases the
+        locks, so those of the closes being posted, locked, are taken
+        again if set.
+        '''
+        pool = Pool()
+        Config = pool.get('cashier.configuration')
+        config = Config(1)
+        if not closes:
+            return
+        cls.write(closes, {'post_phase': phase})
+        if config.post_checkpoint:
+            Transaction().commit()
+            if locked:
+                cls._post_lock(locked)
+
+    @classmethod
+    def _get_sale_lines(cls, sales, description, amounts_to_pay,
+            simulate=False):
+        '''
+        Return the invoice_customer receipt lines of sales.
+        amounts_to_pay is a dictionary with the amount to pay by invoice id.
+        If simulate, sales not invoiced yet use the sale total amount.
+        '''
+        lines = []
+        for sale in sales:
+            if sale.invoices or not simulate:
+                invoice = sale.invoices[0]
+                amount = amounts_to_pay[invoice.id]
+                account = invoice.account
+                party = invoice.party
+            else:
+                invoice = None
+                amount = sale.total_amount
+                party = sale.party
+                account = party.account_receivable_used
+            lines.append(
+                cls._get_receipt_line(
+                    'invoice_customer',
+                    description,
+                    amount,
+                    account,
+                    party,
+                    invoice))
+        return lines
+
+    @classmethod
+    def _get_amounts_to_pay(cls, invoices):
+        '''
+        Return a dictionary with the amount to pay of each invoice id,
+        computed in one read for all the invoices.
+        '''
+        Invoice = Pool().get('account.invoice')
+        return {r['id']: r['amount_to_pay'] for r in Invoice.read(
+                [i.id for i in invoices], ['amount_to_pay'])}
+
     @classmethod
     def _get_receipt_line(cls, type_, description,
             amount, account, party, invoice,
@@ -407,6 +1243,50 @@ class Close(Workflow, ModelSQL, ModelView):
         )
         return line
 
+    @classmethod
+    def _consolidate_lines(cls, lines, description):
+        '''
+        Merge the move_line lines with the same account and party
+        into one line with description.
+        Lines linked to an invoice or an advance are kept as they are
+        because they are needed for reconciliation.
+        '''
+        res = []
+        groups = {}
+        for line in lines:
+            if (line.type != 'move_line' or line.invoice
+                    or line.advance or line.advance_origin):
+                res.append(line)
+                continue
+            key = (line.account, line.party)
+            if key not in groups:
+                groups[key] = []
+                res.append(key)
+            groups[key].append(line)
+
+        lines = []
+        for line in res:
+            if not isinstance(line, tuple):
+                lines.append(line)
+                continue
+            group = groups[line]
+            if len(group) == 1:
+                lines.append(group[0])
+                continue
+            amount = sum(l.amount for l in group)
+            if amount == 0:
+                continue
+            account, party = line
+            lines.append(
+                cls._get_receipt_line(
+                    'move_line',
+                    description,
+                    amount,
+                    account,
+                    party,
+                    None))
+        return lines
+
     @classmethod
     def _get_extra_lines(cls, close):
         '''
@@ -417,279 +1297,736 @@ class Close(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def _get_moneytype_docs(cls, id_, documents):
-        docs = []
-        for doc in documents:
-            if doc[7] == id_:
-                docs.append(doc)
-        return docs
+        '''
+        Return the cash_bank.document of the terminal move type id_
+        from documents, a dictionary keyed by move type id.
+        '''
+        return documents.get(id_, [])
 
     @classmethod
-    def _get_documents(cls, documents, create=True):
-        docs = []
+    def _get_document(cls, moneytype):
+        '''
+        Return a new cash_bank.document (not saved) for the terminal
+        move type moneytype.
+        '''
+        pool = Pool()
+        Doc = pool.get('cash_bank.document')
+        return Doc(
+            type=moneytype.type.cash_bank_document,
+            party=moneytype.party,
+            date=moneytype.date,
+            reference=moneytype.reference,
+            entity=moneytype.entity,
+            amount=moneytype.amount_total
+        )
 
-        if not create:
-            for doc in documents:
-                docs.append(doc[8])
-            return docs
+    @classmethod
+    def _get_transition_sales(cls, closes, state):
+        '''
+        Return the sales of closes that are not in state.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        sales = []
+        for sub_closes in grouped_slice(closes):
+            sales += Sale.search([
+                    ('cashier_close', 'in', [c.id for c in sub_closes]),
+                    ('state', '!=', state),
+                    ], order=[('id', 'ASC')])
+        return sales
 
+    @classmethod
+    def _sales_transition(cls, closes, transition):
+        '''
+        Apply transition on the sales of closes by chunks of the
+        configured post chunk size.
+        '''
         pool = Pool()
-        Doc = pool.get('cash_bank.document')
+        Sale = pool.get('sale.sale')
+        Config = pool.get('cashier.configuration')
 
-        for doc in documents:
-            d = Doc(
-                type=doc[2],
-                party=doc[3],
-                date=doc[4],
-                reference=doc[5],
-                entity=doc[6],
-                amount=doc[0]
-            )
-            d.save()
-            doc[8] = d
-            docs.append(d)
-        return docs
+        config = Config(1)
+        sales = cls._get_transition_sales(
+            closes, _SALE_TRANSITIONS[transition][0])
+        for sub_sales in _chunked(sales, config.post_chunk_size):
+            getattr(Sale, transition)(sub_sales)
+
+    @classmethod
+    def process_sales(cls, closes, transition):
+        '''
+        Apply transition on the sales of the closes that are still in
+        the state the transition was requested for.
+        '''
+        closes = [c for c in closes
+            if c.state == _SALE_TRANSITIONS[transition][1]]
+        cls._sales_transition(closes, transition)
+
+    @classmethod
+    def _sales_transition_request(cls, closes, transition):
+        '''
+        Apply transition on the sales of closes, in a background task if
+        configured.
+        '''
+        pool = Pool()
+        Config = pool.get('cashier.configuration')
+
+        config = Config(1)
+        if config.sale_transition_in_queue:
+            with Transaction().set_context(
+                    queue_name='cashier_close_sale_transition'):
+                cls.__queue__.process_sales(closes, transition)
+        else:
+            cls._sales_transition(closes, transition)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('draft')
     def draft(cls, closes):
-        pool = Pool()
-        Sale = pool.get('sale.sale')
-        sales = []
-        for close in closes:
-            sales += close.sales
-        Sale.draft(sales)
+        cls._sales_transition_request(closes, 'draft')
         write_log('Draft', closes)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('confirmed')
     def confirm(cls, closes):
-        pool = Pool()
-        Sale = pool.get('sale.sale')
-        sales = []
         for close in closes:
             if not close.sales:
                 raise UserError(
                     gettext('cashier.close_no_sales',
                         close=close.rec_name,
                     ))
-            sales += close.sales
-        Sale.quote(sales)
+        cls._sales_transition_request(closes, 'quote')
         cls.set_number(closes)
+        cls.store_cache(closes)
         write_log('Confirmed', closes, 'confirm')
 
     @classmethod
     @ModelView.button
-    @Workflow.transition('posted')
     def post(cls, closes):
         pool = Pool()
         Config = pool.get('cashier.configuration')
-        ConfigCashBank = pool.get('cash_bank.configuration')
-        Sale = pool.get('sale.sale')
-        Receipt = pool.get('cash_bank.receipt')
-        Transfer = pool.get('cash_bank.transfer')
 
         config = Config(1)
-        config_cash_bank = ConfigCashBank(1)
-        receipts = []
+        if config.post_in_queue:
+            cls.post_batch(closes)
+        else:
+            cls.process_post(closes)
+
+    @classmethod
+    def post_batch(cls, closes):
+        '''
+        Post closes in background tasks, one task by group of closes
+        returned by _get_post_groups. Groups are posted in parallel by
+        the queue workers and the closes of a group in a single task.
+        '''
+        closes = [c for c in closes if c.state == 'confirmed']
+        if not closes:
+            return
+        cls.write(closes, {'posting': True})
+        with Transaction().set_context(queue_name='cashier_close_post'):
+            for group in cls._get_post_groups(closes):
+                cls.__queue__.process_post_task(group)
+
+    @classmethod
+    def _get_post_groups(cls, closes):
+        '''
+        Return closes split in lists that can be posted concurrently:
+        closes sharing a cashier or a cash are in the same list,
+        ordered by date and number.
+        '''
+        parents = {}
+
+        def find(key):
+            while parents.setdefault(key, key) != key:
+                key = parents[key]
+            return key
 
         for close in closes:
-            Sale.confirm(close.sales)
-            Sale.process(close.sales)
-            with Transaction().set_context(_skip_warnings=True):
-                # Evita la advertencia de pago anterior a la fecha
-                # de la factura cuando se aplica pagos por adelantado.
-                cls._sales_to_invoice(close.sales)
+            cashier = ('cashier', close.cashier.id)
+            cash = ('cash', close.cashier.cash_bank_cash.id)
+            parents[find(cashier)] = find(cash)
 
-            msg = '[' + close.rec_name + '-' + close.cashier.rec_name + ']'
+        groups = {}
+        for close in closes:
+            groups.setdefault(
+                find(('cashier', close.cashier.id)), []).append(close)
+        return [sorted(g, key=lambda c: (c.date, c.number or '', c.id))
+            for g in groups.values()]
 
-            cash = Decimal('0.0')
-            documents = []
-            lines = []
-            money_plus = []
+    @classmethod
+    def _post_lock(cls, closes):
+        '''
+        Lock the records shared by concurrent postings, always in the same
+        order (closes, cash, advances) and by ascending id.
+        '''
+        pool = Pool()
+        CashBank = pool.get('cash_bank.cash_bank')
+        Advance = pool.get('cash_bank.advance')
 
-            for sale in close.sales:
-                invoice = sale.invoices[0]
-                lines.append(
-                    cls._get_receipt_line(
-                        'invoice_customer',
-                        msg,
-                        invoice.amount_to_pay,
-                        invoice.account,
-                        invoice.party,
-                        invoice))
+        cls.lock(cls.browse(sorted(c.id for c in closes)))
+        CashBank.lock(CashBank.browse(sorted(
+                    {c.cashier.cash_bank_cash.id for c in closes})))
+        Advance.lock(Advance.browse(sorted(
+                    {a.advance.id for c in closes
+                        for a in c.collected_in_advance_apply})))
 
+    @classmethod
+    @Workflow.transition('posted')
+    def process_post(cls, closes):
+        pool = Pool()
+        Config = pool.get('cashier.configuration')
+
+        config = Config(1)
+        chunk_size = config.post_chunk_size
+
+        for phase, method in [
+                ('sales', cls._post_sales),
+                ('invoices', cls._post_invoices),
+                ]:
+            todo = cls._post_todo(closes, phase)
+            sales = [s for c in todo for s in c.sales]
+            for sub_sales in _chunked(sales, chunk_size):
+                method(sub_sales)
+            cls._post_checkpoint(todo, phase)
+
+        plan = cls._get_post_plan(closes)
+        cls._apply_post_plan(plan, closes)
+        cls.write(closes, {'posting': False})
+        write_log('Posted', closes, 'post')
+
+    @classmethod
+    def process_post_task(cls, closes):
+        '''
+        Post closes from the queue task pushed by post_batch.
+        '''
+        try:
+            cls.process_post(closes)
+        except backend.DatabaseOperationalError:
+            # Retried by the queue
+            raise
+        except Exception:
+            cls._post_failed(closes)
+            raise
+
+    @classmethod
+    def _post_failed(cls, closes):
+        '''
+        Reset the posting flag of closes when their posting task failed
+        and will not be retried, so they can be posted or cancelled again.
+        The work of the task done since the last checkpoint is rolled back.
+        '''
+        transaction = Transaction()
+        transaction.rollback()
+        closes = [c for c in cls.browse([c.id for c in closes]) if c.posting]
+        if closes:
+            cls.write(closes, {'posting': False})
+            transaction.commit()
+
+    @classmethod
+    @ModelView.button_action('cashier.wizard_close_simulate_post')
+    def simulate(cls, closes):
+        pass
+
+    @classmethod
+    def simulate_post(cls, closes):
+        '''
+        Return what post would create for closes, without writing
+        anything, as a list of dictionaries (see _get_post_plan_summary).
+        '''
+        plan = cls._get_post_plan(closes, simulate=True)
+        return cls._get_post_plan_summary(plan)
+
+    @classmethod
+    def _get_post_plan_summary(cls, plan):
+        '''
+        Return plan as a list with a dictionary by close:
+            close: close id
+            receipt: dictionary with cash, lines and documents
+            transfers: list of dictionaries with cash_bank_from,
+                cash_bank_to, cash, description, documents and the lines
+                of the receipt to
+        '''
+        pool = Pool()
+        ConfigCashBank = pool.get('cash_bank.configuration')
+        config = ConfigCashBank(1)
+
+        def id_(record):
+            return record.id if record else None
+
+        def line_summary(line):
+            return {
+                'type': line.type,
+                'description': line.description,
+                'account': id_(line.account),
+                'party': id_(line.party),
+                'invoice': id_(line.invoice),
+                'amount': line.amount,
+                }
+
+        def document_summary(doc):
+            return {
+                'type': id_(doc.type),
+                'party': id_(doc.party),
+                'date': doc.date,
+                'reference': doc.reference,
+                'entity': doc.entity,
+                'amount': doc.amount,
+                }
+
+        # Netted transfers are listed under all the closes of their
+        # terminals
+        close_transfers = {}
+        for transfer in plan['transfers']:
+            closes = [transfer.cashier_close] + [t.close
+                for t in transfer.cashier_close_terminals]
+            for close_id in {c.id for c in closes}:
+                close_transfers.setdefault(close_id, []).append(transfer)
+
+        res = []
+        for close, receipt in plan['receipts']:
+            transfers = []
+            for transfer in close_transfers.get(close.id, []):
+                _, lines = transfer._get_cashier_close_receipt_lines(
+                    config.account_transfer)
+                transfers.append({
+                        'cash_bank_from': id_(transfer.cash_bank_from),
+                        'cash_bank_to': id_(transfer.cash_bank_to),
+                        'cash': transfer.cash,
+                        'description': transfer.description,
+                        'documents': [document_summary(d)
+                            for d in transfer.documents],
+                        'lines': [line_summary(l) for l in lines],
+                        })
+            res.append({
+                    'close': close.id,
+                    'receipt': {
+                        'cash': receipt.cash,
+                        'lines': [line_summary(l) for l in receipt.lines],
+                        'documents': [document_summary(d)
+                            for d in receipt.documents],
+                        },
+                    'transfers': transfers,
+                    })
+        return res
+
+    @classmethod
+    def _get_post_plan(cls, closes, simulate=False):
+        '''
+        Compute everything post has to create for closes without writing.
+        Closes that already completed a phase of the posting are skipped
+        for that phase.
+        Returns a dictionary with:
+            receipts: list of (close, cash_bank.receipt) not saved
+            documents: dictionary of cash_bank.document by move type id
+            transfers: list of cash_bank.transfer not saved
+            discount_lines: list of cashier.close.discount not saved
+            closes: list of closes with transfers to create
+        If simulate, the plan is only to be summarized and the sales not
+        invoiced yet get a receipt line with their total amount.
+        '''
+        pool = Pool()
+        Config = pool.get('cashier.configuration')
+
+        config = Config(1)
+        receipt_closes = cls._post_todo(closes, 'receipt')
+        transfer_closes = cls._post_todo(closes, 'transfers')
+        cls._post_prefetch(transfer_closes)
+        sales = [s for c in receipt_closes for s in c.sales]
+        cls._post_prefetch_sales(sales)
+        amounts_to_pay = cls._get_amounts_to_pay(
+            [s.invoices[0] for s in sales if s.invoices])
+
+        documents = {}
+        receipts = []
+        transfers = []
+        discount_lines = []
+        for close in receipt_closes:
+            receipts.append((close,
+                cls._get_close_receipt(close, documents, amounts_to_pay,
+                    simulate=simulate)))
+        for close in transfer_closes:
+            if close not in receipt_closes:
+                # Receipt posted by a previous attempt
+                for terminal in close.terminals:
+                    for moneytype in terminal.types:
+                        if moneytype.document:
+                            documents[moneytype.id] = [moneytype.document]
             for terminal in close.terminals:
-                for moneytype in terminal.types:
-                    is_document = moneytype.type.is_document
-                    if is_document:
-                        documents.append([
-                            moneytype.amount_total,
-                            moneytype.amount_ignore,
-                            moneytype.type.cash_bank_document,
-                            moneytype.party,
-                            moneytype.date,
-                            moneytype.reference,
-                            moneytype.entity,
-                            moneytype.id,
-                            None  # cash_bank.document
-                            ])
-                    else:
-                        cash += moneytype.amount_total
-                    cls._add_money_plus(money_plus, moneytype)
-
-            for rcv in close.customers_receivable:
-                lines.append(
-                    cls._get_receipt_line(
-                        'move_line',
-                        msg + ' ' + rcv.description if rcv.description else msg,
-                        -rcv.amount_rp,
-                        rcv.account,
-                        rcv.party,
-                        None))
+                terminal_plan = cls._get_terminal_plan(
+                    close, terminal, documents)
+                transfers += terminal_plan['transfers']
+                discount_lines += terminal_plan['discount_lines']
+        if config.post_net_transfers:
+            transfers = cls._get_net_transfers(transfers)
+
+        return {
+            'receipts': receipts,
+            'documents': documents,
+            'transfers': transfers,
+            'discount_lines': discount_lines,
+            'closes': transfer_closes,
+            }
 
-            for rcv in close.customers_payable:
-                lines.append(
-                    cls._get_receipt_line(
-                        'move_line',
-                        msg + ' ' + rcv.description if rcv.description else msg,
-                        rcv.amount_rp,
-                        rcv.account,
-                        rcv.party,
-                        None))
+    @classmethod
+    def _get_close_receipt(cls, close, documents, amounts_to_pay,
+            simulate=False):
+        '''
+        Return the cash_bank.receipt (not saved) of close.
+        The documents of the close are added to documents by move type id.
+        amounts_to_pay is a dictionary with the amount to pay by invoice id.
+        '''
+        pool = Pool()
+        Config = pool.get('cashier.configuration')
+        Receipt = pool.get('cash_bank.receipt')
 
-            for cia in close.collected_in_advance:
-                lines.append(
-                    cls._get_receipt_line(
-                        'advance_in_create',
-                        msg + ' ' + cia.description if cia.description else msg,
-                        cia.amount_collected,
-                        cia.account,
-                        cia.party,
-                        None, None, cia.advance_origin))
+        config = Config(1)
+        msg = '[' + close.rec_name + '-' + close.cashier.rec_name + ']'
 
-            for cia in close.collected_in_advance_apply:
+        cash = Decimal('0.0')
+        docs = []
+        lines = []
+        money_plus = []
+
+        lines += cls._get_sale_lines(close.sales, msg, amounts_to_pay,
+            simulate=simulate)
+
+        for terminal in close.terminals:
+            for moneytype in terminal.types:
+                is_document = moneytype.type.is_document
+                if is_document:
+                    doc = cls._get_document(moneytype)
+                    documents.setdefault(moneytype.id, []).append(doc)
+                    docs.append(doc)
+                else:
+                    cash += moneytype.amount_total
+                cls._add_money_plus(money_plus, moneytype)
+
+        for rcv in close.customers_receivable:
+            lines.append(
+                cls._get_receipt_line(
+                    'move_line',
+                    msg + ' ' + rcv.description if rcv.description else msg,
+                    -rcv.amount_rp,
+                    rcv.account,
+                    rcv.party,
+                    None))
+
+        for rcv in close.customers_payable:
+            lines.append(
+                cls._get_receipt_line(
+                    'move_line',
+                    msg + ' ' + rcv.description if rcv.description else msg,
+                    rcv.amount_rp,
+                    rcv.account,
+                    rcv.party,
+                    None))
+
+        for cia in close.collected_in_advance:
+            lines.append(
+                cls._get_receipt_line(
+                    'advance_in_create',
+                    msg + ' ' + cia.description if cia.description else msg,
+                    cia.amount_collected,
+                    cia.account,
+                    cia.party,
+                    None, None, cia.advance_origin))
+
+        for cia in close.collected_in_advance_apply:
+            lines.append(
+                cls._get_receipt_line(
+                    'advance_in_apply',
+                    msg + ' ' + cia.description if cia.description else msg,
+                    -cia.amount_apply,
+                    cia.advance.receipt_line.account,
+                    cia.party,
+                    None, cia.advance, None))
+
+            if not cia.affect_close_total:
                 lines.append(
                     cls._get_receipt_line(
-                        'advance_in_apply',
+                        'move_line',
                         msg + ' ' + cia.description if cia.description else msg,
-                        -cia.amount_apply,
-                        cia.advance.receipt_line.account,
+                        cia.amount_apply_ignore,
+                        cia.account_alternate,
                         cia.party,
-                        None, cia.advance, None))
-
-                if not cia.affect_close_total:
-                    lines.append(
-                        cls._get_receipt_line(
-                            'move_line',
-                            msg + ' ' + cia.description if cia.description else msg,
-                            cia.amount_apply_ignore,
-                            cia.account_alternate,
-                            cia.party,
-                            None, None, None))
-
-            if close.diff != 0:
-                lines.append(
-                    cls._get_receipt_line(
-                        'move_line',
-                        msg + ' Diff',
-                        -close.diff,
-                        config.diff_account,
-                        None, None))
+                        None, None, None))
+
+        if close.diff != 0:
+            lines.append(
+                cls._get_receipt_line(
+                    'move_line',
+                    msg + ' Diff',
+                    -close.diff,
+                    config.diff_account,
+                    None, None))
+
+        for mp in money_plus:
+            lines.append(
+                cls._get_receipt_line(
+                    'move_line',
+                    msg + mp[2],
+                    mp[1],
+                    mp[0],
+                    None, None))
+
+        lines += cls._get_extra_lines(close)
+        if config.post_consolidate_lines:
+            lines = cls._consolidate_lines(lines, msg)
+
+        return Receipt(
+            date=close.date,
+            cash_bank=close.cashier.cash_bank_cash,
+            type=close.cashier.receipt_type_cash,
+            description=msg,
+            party=close.company.party,
+            cash=cash,
+            documents=docs,
+            lines=lines
+        )
 
-            for mp in money_plus:
-                lines.append(
-                    cls._get_receipt_line(
-                        'move_line',
-                        msg + mp[2],
-                        mp[1],
-                        mp[0],
-                        None, None))
+    @classmethod
+    def _get_terminal_plan(cls, close, terminal, documents):
+        '''
+        Return the part of the post plan of the terminal move terminal of
+        close, as a dictionary with:
+            transfers: list of cash_bank.transfer not saved
+            discount_lines: list of cashier.close.discount not saved
+        Terminals do not depend on each other, so each one is planned on
+        its own with a single walk of its move types and the plans are
+        merged by _get_post_plan.
+        '''
+        discount_lines = []
+        for moneytype in terminal.types:
+            if not moneytype.discount_lines:
+                discount_lines += cls._get_discount_lines(moneytype)
+        return {
+            'transfers': cls._get_terminal_transfers(
+                close, terminal, documents),
+            'discount_lines': discount_lines,
+            }
 
-            lines += cls._get_extra_lines(close)
+    @classmethod
+    def _get_terminal_transfers(cls, close, terminal, documents):
+        '''
+        Return the cash_bank.transfer (not saved) of the terminal move
+        terminal. documents is the dictionary of cash_bank.document by
+        move type id.
+        '''
+        pool = Pool()
+        Transfer = pool.get('cash_bank.transfer')
+
+        msg = '[' + close.rec_name + '-' + close.cashier.name + ']' + \
+            '[' + terminal.terminal.name + ']'
+        group = terminal.terminal.group
+        transfers = []
+        cash = Decimal('0.0')
+        docs = []
+        for moneytype in terminal.types:
+            docs += cls._get_moneytype_docs(moneytype.id, documents)
+            if not moneytype.type.is_document:
+                cash += moneytype.amount_total
+
+            if not group:
+                transfer = Transfer(
+                    company=close.company,
+                    date=close.date,
+                    currency=close.currency,
+                    cash_bank_from=close.cashier.cash_bank_cash,
+                    type_from=close.cashier.receipt_type_cash_out,
+                    cash_bank_to=terminal.terminal.cash_bank,
+                    type_to=terminal.terminal.receipt_type,
+                    cash=cash,
+                    cashier_close=close,
+                    cashier_close_terminal=terminal,
+                    cashier_close_moneytype=moneytype,
+                    cashier_close_terminals=[],
+                    description=msg + '[' + moneytype.type.type.name + ']',
+                    documents=docs
+                    )
+                transfers.append(transfer)
+                cash = Decimal('0.0')
+                docs = []
 
-            cash_receipt = Receipt(
+        if group:
+            transfer = Transfer(
+                company=close.company,
                 date=close.date,
-                cash_bank=close.cashier.cash_bank_cash,
-                type=close.cashier.receipt_type_cash,
-                description=msg,
-                party=close.company.party,
+                currency=close.currency,
+                cash_bank_from=close.cashier.cash_bank_cash,
+                type_from=close.cashier.receipt_type_cash_out,
+                cash_bank_to=terminal.terminal.cash_bank,
+                type_to=terminal.terminal.receipt_type,
                 cash=cash,
-                documents=cls._get_documents(documents),
-                lines=lines
-            )
-            cash_receipt.save()
+                cashier_close=close,
+                cashier_close_terminal=terminal,
+                cashier_close_moneytype=None,
+                cashier_close_terminals=[],
+                description=msg,
+                documents=docs
+                )
+            transfers.append(transfer)
+        return transfers
 
-            close.cash_bank_receipt = cash_receipt
-            close.save()
+    @classmethod
+    def _get_net_transfer_key(cls, transfer):
+        return (transfer.company, transfer.currency, transfer.date,
+            transfer.cash_bank_from, transfer.type_from,
+            transfer.cash_bank_to, transfer.type_to)
 
-            receipts.append(cash_receipt)
+    @classmethod
+    def _get_net_transfers(cls, transfers):
+        '''
+        Merge the cash_bank.transfer (not saved) of the terminals that
+        share date, source cash, destination cash_bank and receipt types
+        into one transfer by group.
+        The merged transfer is linked to the first close of the group and
+        to all the terminal moves it includes.
+        '''
+        pool = Pool()
+        Transfer = pool.get('cash_bank.transfer')
 
-        Receipt.confirm(receipts)
-        Receipt.post(receipts)
-        write_log('Posted', closes, 'post')
+        groups = {}
+        for transfer in transfers:
+            groups.setdefault(
+                cls._get_net_transfer_key(transfer), []).append(transfer)
 
-        transfers = []
+        res = []
+        for key, group in groups.items():
+            if len(group) == 1:
+                res.append(group[0])
+                continue
+            company, currency, date, cash_bank_from, type_from, \
+                cash_bank_to, type_to = key
+            closes = _related(group, 'cashier_close')
+            terminals = _related(group, 'cashier_close_terminal')
+            cash = Decimal('0.0')
+            docs = []
+            for transfer in group:
+                cash += transfer.cash
+                docs += transfer.documents
+            res.append(Transfer(
+                    company=company,
+                    date=date,
+                    currency=currency,
+                    cash_bank_from=cash_bank_from,
+                    type_from=type_from,
+                    cash_bank_to=cash_bank_to,
+                    type_to=type_to,
+                    cash=cash,
+                    cashier_close=closes[0],
+                    cashier_close_terminal=None,
+                    cashier_close_moneytype=None,
+                    cashier_close_terminals=terminals,
+                    description='[' + ', '.join(
+                        c.rec_name for c in closes) + ']'
+                        '[' + cash_bank_to.name + ']',
+                    documents=docs
+                    ))
+        return res
 
-        for close in closes:
-            close_msg = '[' + close.rec_name + '-' + \
-                    close.cashier.name + ']'
-            for terminal in close.terminals:
-                msg = close_msg + '[' + terminal.terminal.name + ']'
-                group = terminal.terminal.group
-                cash = Decimal('0.0')
-                docs = []
-                for moneytype in terminal.types:
-                    is_document = moneytype.type.is_document
-                    if is_document:
-                        docs += cls._get_moneytype_docs(
-                                moneytype.id, documents)
-                    else:
-                        cash += moneytype.amount_total
-
-                    if not group:
-                        transfer = Transfer(
-                            company=close.company,
-                            date=close.date,
-                            currency=close.currency,
-                            cash_bank_from=close.cashier.cash_bank_cash,
-                            type_from=close.cashier.receipt_type_cash_out,
-                            cash_bank_to=terminal.terminal.cash_bank,
-                            type_to=terminal.terminal.receipt_type,
-                            cash=cash,
-                            cashier_close=close,
-                            cashier_close_terminal=terminal,
-                            cashier_close_moneytype=moneytype,
-                            description=msg + '[' + moneytype.type.type.name + ']',
-                            documents=cls._get_documents(docs, False)
-                            )
-                        transfer.save()
-                        transfers.append(transfer)
-                        cash = Decimal('0.0')
-                        docs = []
-
-                if group:
-                    transfer = Transfer(
-                        company=close.company,
-                        date=close.date,
-                        currency=close.currency,
-                        cash_bank_from=close.cashier.cash_bank_cash,
-                        type_from=close.cashier.receipt_type_cash_out,
-                        cash_bank_to=terminal.terminal.cash_bank,
-                        type_to=terminal.terminal.receipt_type,
-                        cash=cash,
-                        cashier_close=close,
-                        cashier_close_terminal=terminal,
-                        cashier_close_moneytype=None,
-                        description=msg,
-                        documents=cls._get_documents(docs, False)
-                        )
-                    transfer.save()
-                    transfers.append(transfer)
+    @classmethod
+    def _get_moneytype_discounts(cls, moneytype):
+        '''
+        Return the discounts to transfer of the terminal move type
+        moneytype as lists of account, amount and description.
+        They are read from the discount lines stored when posting and
+        only computed when there are none.
+        '''
+        lines = moneytype.discount_lines
+        if not lines:
+            lines = cls._get_discount_lines(moneytype)
+        return [[l.account, l.amount, l.description] for l in lines]
 
+    @classmethod
+    def _get_discount_lines(cls, moneytype):
+        '''
+        Return the cashier.close.discount (not saved) of the discounts and
+        charges of the terminal move type moneytype and of its amounts.
+        '''
+        pool = Pool()
+        Discount = pool.get('cashier.close.discount')
+
+        close = moneytype.move.close
+        digits = close.currency.digits
+        lines = []
+        for account, amount, description in cls._get_discounts(
+                moneytype.type, moneytype.amount_total, digits):
+            lines.append(Discount(
+                    close=close,
+                    move_type=moneytype,
+                    move_amount=None,
+                    account=account,
+                    amount=amount,
+                    description=description))
+        for mnt in moneytype.amounts:
+            for account, amount, description in cls._get_discounts(
+                    mnt.amount_type, mnt.amount, digits):
+                lines.append(Discount(
+                        close=close,
+                        move_type=moneytype,
+                        move_amount=mnt,
+                        account=account,
+                        amount=amount,
+                        description=description))
+        return lines
+
+    @classmethod
+    def _apply_post_plan(cls, plan, locked):
+        '''
+        Create and post in bulk what _get_post_plan computed.
+        locked are the closes being posted, their shared records are locked
+        only while the plan is applied and again after each checkpoint.
+        '''
+        pool = Pool()
+        Receipt = pool.get('cash_bank.receipt')
+        Transfer = pool.get('cash_bank.transfer')
+        Doc = pool.get('cash_bank.document')
+        MoveType = pool.get('cashier.close.terminal.move.type')
+        Discount = pool.get('cashier.close.discount')
+
+        # A concurrent posting of the same records fails to lock and the
+        # queue worker retries the task later
+        cls._post_lock(locked)
+
+        receipts = [r for _, r in plan['receipts']]
+        transfers = plan['transfers']
+
+        # Documents are shared by receipts and transfers,
+        # so they must exist before both are created
+        new_docs = {}
+        for type_id, docs in plan['documents'].items():
+            for doc in docs:
+                if doc.id is None or doc.id < 0:
+                    new_docs[type_id] = doc
+        Doc.save(list(new_docs.values()))
+        to_write = []
+        for type_id, doc in new_docs.items():
+            to_write.extend(([MoveType(type_id)], {
+                        'document': doc.id,
+                        }))
+        if to_write:
+            MoveType.write(*to_write)
+
+        Receipt.save(receipts)
+        to_write = []
+        for close, receipt in plan['receipts']:
+            to_write.extend(([close], {
+                        'cash_bank_receipt': receipt.id,
+                        }))
+        if to_write:
+            cls.write(*to_write)
+
+        Receipt.confirm(receipts)
+        Receipt.post(receipts)
+        cls._post_checkpoint(
+            [c for c, _ in plan['receipts']], 'receipt', locked)
+
+        # The receipts to of the transfers read the stored discounts
+        Discount.save(plan['discount_lines'])
+        Transfer.save(transfers)
         Transfer.confirm(transfers)
         Transfer.post(transfers)
+        cls._post_checkpoint(plan['closes'], 'transfers', locked)
 
     @classmethod
     def _get_discounts_charges(cls, values, field, amount, digits, add_charge):
@@ -745,20 +2082,145 @@ class Close(Workflow, ModelSQL, ModelView):
     @ModelView.button
     @Workflow.transition('cancel')
     def cancel(cls, closes):
-        pool = Pool()
-        Sale = pool.get('sale.sale')
-        sales = []
         for close in closes:
-            sales += close.sales
-        Sale.cancel(sales)
+            if close.post_phase:
+                raise UserError(
+                    gettext('cashier.close_cancel_post_phase',
+                        close=close.rec_name,
+                    ))
+        cls._sales_transition_request(closes, 'cancel')
         write_log('Cancelled', closes, 'cancel')
 
 
-class CloseDetailMixin(ModelSQL, ModelView):
+class SimulatePostStart(ModelView):
+    "Cashier Close Simulate Post"
+    __name__ = 'cashier.close.simulate_post.start'
+    result = fields.Text('Result', readonly=True)
+
+
+class SimulatePost(Wizard):
+    "Cashier Close Simulate Post"
+    __name__ = 'cashier.close.simulate_post'
+    start = StateView('cashier.close.simulate_post.start',
+        'cashier.close_simulate_post_start_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_start(self, fields):
+        pool = Pool()
+        Close = pool.get('cashier.close')
+        Account = pool.get('account.account')
+        Party = pool.get('party.party')
+        CashBank = pool.get('cash_bank.cash_bank')
+
+        def name(Model, id_):
+            return Model(id_).rec_name if id_ else ''
+
+        def lines_text(lines):
+            return ['    %s | %s | %s | %s' % (
+                    line['description'],
+                    name(Account, line['account']),
+                    name(Party, line['party']),
+                    line['amount'])
+                for line in lines]
+
+        text = []
+        for summary in Close.simulate_post(self.records):
+            receipt = summary['receipt']
+            text.append(Close(summary['close']).rec_name)
+            text.append('  Cash: %s' % receipt['cash'])
+            text.append('  Documents: %s' % sum(
+                    d['amount'] for d in receipt['documents']))
+            text += lines_text(receipt['lines'])
+            for transfer in summary['transfers']:
+                text.append('  %s -> %s: %s' % (
+                        transfer['description'],
+                        name(CashBank, transfer['cash_bank_to']),
+                        transfer['cash']))
+                text += lines_text(transfer['lines'])
+            text.append('')
+        return {
+            'result': '\n'.join(text),
+            }
+
+
+class CloseDiscount(ModelSQL, ModelView):
+    "Cashier Close Discount"
+    __name__ = "cashier.close.discount"
+    close = fields.Many2One('cashier.close',
+        'Close', required=True, readonly=True, ondelete='CASCADE')
+    move_type = fields.Many2One('cashier.close.terminal.move.type',
+        'Money Type', required=True, readonly=True, ondelete='CASCADE')
+    move_amount = fields.Many2One('cashier.close.terminal.move.amount',
+        'Money Amount', readonly=True, ondelete='CASCADE')
+    account = fields.Many2One('account.account',
+        'Account', required=True, readonly=True)
+    amount = Monetary('Amount', required=True, readonly=True,
+        digits='currency', currency='currency')
+    description = fields.Char('Description', readonly=True)
+    currency = fields.Function(
+        fields.Many2One('currency.currency', 'Currency'),
+        'get_close_fields')
+
+    @classmethod
+    def get_close_fields(cls, discounts, names):
+        return _get_close_fields(cls, discounts, names, ['close'])
+
+    @fields.depends('close', '_parent_close.currency')
+    def on_change_with_currency(self, name=None):
+        if self.close and self.close.currency:
+            return self.close.currency.id
+
+
+class CloseCacheMixin(object):
+    '''
+    Update the stored totals of the closes when their details are created,
+    written or deleted.
+    '''
+    __slots__ = ()
+    # Fields that do not change the totals of the close
+    _close_cache_ignored = set()
+    # Subtotals of the close computed from the records
+    _close_cache_amounts = []
+
+    @classmethod
+    def _get_cache_closes(cls, records):
+        return [r.close for r in records]
+
+    @classmethod
+    def create(cls, vlist):
+        Close = Pool().get('cashier.close')
+        records = super(CloseCacheMixin, cls).create(vlist)
+        Close.update_cache(cls._get_cache_closes(records),
+            cls._close_cache_amounts)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        Close = Pool().get('cashier.close')
+        actions = iter(args)
+        records = []
+        for sub_records, values in zip(actions, actions):
+            if not set(values) <= cls._close_cache_ignored:
+                records += sub_records
+        closes = cls._get_cache_closes(records)
+        super(CloseCacheMixin, cls).write(*args)
+        Close.update_cache(closes + cls._get_cache_closes(records),
+            cls._close_cache_amounts)
+
+    @classmethod
+    def delete(cls, records):
+        Close = Pool().get('cashier.close')
+        closes = cls._get_cache_closes(records)
+        super(CloseCacheMixin, cls).delete(records)
+        Close.update_cache(closes, cls._close_cache_amounts)
+
+
+class CloseDetailMixin(CloseCacheMixin, ModelSQL, ModelView):
     close = fields.Many2One('cashier.close',
         'Close', required=True, ondelete='CASCADE')
     company = fields.Function(fields.Many2One('company.company', 'Company'),
-        'on_change_with_company')
+        'get_close_fields')
     party = fields.Many2One('party.party', 'Party',
         states={
             'required': Bool(Eval('party_required')),
@@ -782,15 +2244,19 @@ class CloseDetailMixin(ModelSQL, ModelView):
         'get_amount_total')
     currency = fields.Function(
         fields.Many2One('currency.currency', 'Currency'),
-        'on_change_with_currency')
+        'get_close_fields')
     close_state = fields.Function(
         fields.Selection(STATES, 'Close State'),
-        'on_change_with_close_state')
+        'get_close_fields')
 
     @staticmethod
     def default_amount():
         return Decimal('0.0')
 
+    @classmethod
+    def get_close_fields(cls, records, names):
+        return _get_close_fields(cls, records, names, ['close'])
+
     @staticmethod
     def default_amount_ignore():
         return Decimal('0.0')
@@ -837,6 +2303,8 @@ class CloseDetailMixin(ModelSQL, ModelView):
 class MoneyTerminalMove(CloseDetailMixin):
     "Cashier Close Money Terminal Move"
     __name__ = "cashier.close.terminal.move"
+    _close_cache_ignored = {'transfer'}
+    _close_cache_amounts = ['terminal_amount', 'terminal_amount_ignore']
     terminal = fields.Many2One('cashier.terminal',
         'Money Terminal', required=True,
         domain=[
@@ -847,6 +2315,33 @@ class MoneyTerminalMove(CloseDetailMixin):
     types = fields.One2Many('cashier.close.terminal.move.type',
         'move', 'Money Types',
         states=_STATES_DOC, depends=_DEPENDS_DOC)
+    transfer = fields.Many2One('cash_bank.transfer', 'Net Transfer',
+        readonly=True,
+        help='The transfer shared with other terminals when the '
+        'transfers are netted.')
+
+    @classmethod
+    def __setup__(cls):
+        super(MoneyTerminalMove, cls).__setup__()
+        for name in ['amount', 'amount_ignore', 'amount_total']:
+            getattr(cls, name).getter = 'get_amounts'
+
+    @classmethod
+    def get_amounts(cls, moves, names):
+        pool = Pool()
+        MoveAmount = pool.get('cashier.close.terminal.move.amount')
+        sums = MoveAmount.get_sums('move', [m.id for m in moves])
+        return _get_sum_values(moves, names, sums,
+            lambda m: m.close.currency)
+
+    @classmethod
+    def copy(cls, terminals, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('transfer', None)
+        return super(MoneyTerminalMove, cls).copy(terminals, default=default)
 
     @fields.depends('terminal')
     def on_change_with_party_required(self, name=None):
@@ -888,9 +2383,11 @@ class MoneyTerminalMove(CloseDetailMixin):
         return self._get_amount(self.types, False)
 
 
-class MoneyTerminalMoveType(ModelSQL, ModelView):
+class MoneyTerminalMoveType(CloseCacheMixin, ModelSQL, ModelView):
     "Cashier Close Money Terminal Move Type"
     __name__ = "cashier.close.terminal.move.type"
+    _close_cache_ignored = {'document'}
+    _close_cache_amounts = ['terminal_amount', 'terminal_amount_ignore']
     move = fields.Many2One('cashier.close.terminal.move',
         'Terminal Move', required=True, ondelete='CASCADE')
     type = fields.Many2One('cashier.terminal.moneytype',
@@ -926,21 +2423,54 @@ class MoneyTerminalMoveType(ModelSQL, ModelView):
     amounts = fields.One2Many('cashier.close.terminal.move.amount',
         'type', 'Amount',
         states=_STATES_DOC, depends=_DEPENDS_DOC)
+    document = fields.Many2One('cash_bank.document', 'Document',
+        readonly=True,
+        states={
+            'invisible': Not(Bool(Eval('is_document'))),
+        }, depends=['is_document'])
+    discount_lines = fields.One2Many('cashier.close.discount', 'move_type',
+        'Discounts', readonly=True)
     amount = fields.Function(Monetary('Amount',
         digits='currency', currency='currency'),
-        'on_change_with_amount')
+        'get_amounts')
     amount_ignore = fields.Function(Monetary('Ignored',
         digits='currency', currency='currency'),
-        'on_change_with_amount_ignore')
+        'get_amounts')
     amount_total = fields.Function(Monetary('Total',
         digits='currency', currency='currency'),
-        'on_change_with_amount_total')
+        'get_amounts')
     currency = fields.Function(
         fields.Many2One('currency.currency', 'Currency'),
-        'on_change_with_currency')
+        'get_close_fields')
     close_state = fields.Function(
         fields.Selection(STATES, 'Close State'),
-        'on_change_with_close_state')
+        'get_close_fields')
+
+    @classmethod
+    def _get_cache_closes(cls, records):
+        return [r.move.close for r in records]
+
+    @classmethod
+    def get_close_fields(cls, types, names):
+        return _get_close_fields(cls, types, names, ['move', 'close'])
+
+    @classmethod
+    def get_amounts(cls, types, names):
+        pool = Pool()
+        MoveAmount = pool.get('cashier.close.terminal.move.amount')
+        sums = MoveAmount.get_sums('type', [t.id for t in types])
+        return _get_sum_values(types, names, sums,
+            lambda t: t.move.close.currency)
+
+    @classmethod
+    def copy(cls, types, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('document', None)
+        default.setdefault('discount_lines', None)
+        return super(MoneyTerminalMoveType, cls).copy(types, default=default)
 
     @fields.depends('move', '_parent_move.close_state')
     def on_change_with_close_state(self, name=None):
@@ -988,9 +2518,10 @@ class MoneyTerminalMoveType(ModelSQL, ModelView):
         return res
 
 
-class MoneyTerminalMoveAmount(ModelSQL, ModelView):
+class MoneyTerminalMoveAmount(CloseCacheMixin, ModelSQL, ModelView):
     "Cashier Close Money Terminal Move Amount"
     __name__ = "cashier.close.terminal.move.amount"
+    _close_cache_amounts = ['terminal_amount', 'terminal_amount_ignore']
     type = fields.Many2One('cashier.close.terminal.move.type',
         'Money Type', required=True, ondelete='CASCADE')
     amount_type = fields.Many2One('cashier.terminal.moneytype.amount',
@@ -1005,10 +2536,63 @@ class MoneyTerminalMoveAmount(ModelSQL, ModelView):
         states=_STATES_DOC, depends=_DEPENDS_DOC)
     currency = fields.Function(
         fields.Many2One('currency.currency', 'Currency'),
-        'on_change_with_currency')
+        'get_close_fields')
     close_state = fields.Function(
         fields.Selection(STATES, 'Close State'),
-        'on_change_with_close_state')
+        'get_close_fields')
+
+    @classmethod
+    def _get_cache_closes(cls, records):
+        return [r.type.move.close for r in records]
+
+    @classmethod
+    def get_close_fields(cls, amounts, names):
+        return _get_close_fields(
+            cls, amounts, names, ['type', 'move', 'close'])
+
+    @classmethod
+    def get_sums(cls, group, ids):
+        '''
+        Return a dictionary by id of group ('type', 'move' or 'close')
+        with the sum of the amounts that affect the close total and the
+        sum of the ignored ones, computed in one query.
+        '''
+        pool = Pool()
+        Move = pool.get('cashier.close.terminal.move')
+        MoveType = pool.get('cashier.close.terminal.move.type')
+        AmountType = pool.get('cashier.terminal.moneytype.amount')
+        cursor = Transaction().connection.cursor()
+
+        move = Move.__table__()
+        move_type = MoveType.__table__()
+        move_amount = cls.__table__()
+        amount_type = AmountType.__table__()
+        key = {
+            'type': move_amount.type,
+            'move': move_type.move,
+            'close': move.close,
+            }[group]
+
+        res = {i: [Decimal('0.0'), Decimal('0.0')] for i in ids}
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*move_amount.join(move_type,
+                    condition=move_amount.type == move_type.id
+                    ).join(move,
+                    condition=move_type.move == move.id
+                    ).join(amount_type,
+                    condition=move_amount.amount_type == amount_type.id
+                    ).select(
+                    key, amount_type.affect_close_total,
+                    Sum(move_amount.amount),
+                    where=reduce_ids(key, sub_ids),
+                    group_by=[key, amount_type.affect_close_total]))
+            for id_, affect, amount in cursor:
+                if amount is None:
+                    continue
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                res[id_][0 if affect else 1] += amount
+        return {i: tuple(v) for i, v in res.items()}
 
     @staticmethod
     def default_amount():
@@ -1066,6 +2650,7 @@ class CustomerReceivablePayableMixin(CloseDetailMixin):
 class CustomerReceivable(CustomerReceivablePayableMixin):
     "Cashier Close Customer Receivable"
     __name__ = "cashier.close.customer_receivable"
+    _close_cache_amounts = ['customer_receivable_amount']
 
     @fields.depends('party')
     def on_change_with_account(self, name=None):
@@ -1078,6 +2663,7 @@ class CustomerReceivable(CustomerReceivablePayableMixin):
 class CustomerPayable(CustomerReceivablePayableMixin):
     "Cashier Close Customer Payable"
     __name__ = "cashier.close.customer_payable"
+    _close_cache_amounts = ['customer_payable_amount']
 
     @fields.depends('party')
     def on_change_with_account(self, name=None):
@@ -1090,6 +2676,7 @@ class CustomerPayable(CustomerReceivablePayableMixin):
 class ColletedInAdvance(CloseDetailMixin):
     "Cashier Close Collected in Advance"
     __name__ = "cashier.close.advance"
+    _close_cache_amounts = ['collected_in_advance_amount']
     account = fields.Many2One('account.account', "Account",
         required=True,
         domain=[
@@ -1136,6 +2723,8 @@ class ColletedInAdvance(CloseDetailMixin):
 class ColletedInAdvanceApply(CloseDetailMixin):
     "Cashier Close Collected in Advance Applied"
     __name__ = "cashier.close.advance.apply"
+    _close_cache_amounts = ['collected_in_advance_apply_amount',
+        'collected_in_advance_apply_amount_ignore']
     advance = fields.Many2One('cash_bank.advance',
         'Advance', required=True,
         domain=[
@@ -29,6 +29,32 @@ class Configuration(
             ('closed', '!=', True),
             ('company', '=', Eval('context', {}).get('company', -1)),
         ]))
+    post_chunk_size = fields.Integer('Post Chunk Size',
+        domain=[
+            ['OR',
+                ('post_chunk_size', '=', None),
+                ('post_chunk_size', '>', 0),
+            ]
+        ],
+        help='If set, the sales of the closes are processed, invoiced, '
+        'confirmed, set to draft and cancelled by batches of this size.')
+    post_checkpoint = fields.Boolean('Post Checkpoints',
+        help='Commit each completed phase of the posting of closes, '
+        'so a failed posting resumes from the first unfinished phase.')
+    post_in_queue = fields.Boolean('Post in Queue',
+        help='Post the closes in background tasks, one task by group of '
+        'closes sharing a cashier or a cash.')
+    sale_transition_in_queue = fields.Boolean('Sale Transitions in Queue',
+        help='Change the state of the sales in a background task when a '
+        'close is confirmed, set to draft or cancelled.')
+    post_consolidate_lines = fields.Boolean('Consolidate Receipt Lines',
+        help='Merge the move lines of the receipts created by the closes '
+        'that share the same account and party. '
+        'Lines linked to an invoice or an advance are kept.')
+    post_net_transfers = fields.Boolean('Net Transfers',
+        help='Create one transfer by date, source cash, destination '
+        'cash/bank and receipt type for all the terminals of the closes '
+        'posted together.')
 
     @classmethod
     def multivalue_model(cls, field):
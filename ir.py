@@ -0,0 +1,15 @@
+#This file is part of tryton-cashier project. The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+__all__ = ['Cron']
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.append(
+            ('cashier.close|backfill_cache', "Store Cashier Close Totals"))
@@ -1,12 +1,91 @@
 #This file is part of tryton-cashier project. The COPYRIGHT file at the top level of
 #this repository contains the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from trytond.model import fields
+from trytond.transaction import Transaction
 
-__all__ = ['Sale']
+__all__ = ['Sale', 'SaleLine']
 
 
 class Sale(metaclass=PoolMeta):
     __name__ = 'sale.sale'
     cashier_close = fields.Many2One(
         'cashier.close', 'Cashier Close')
+
+    @classmethod
+    def create(cls, vlist):
+        Close = Pool().get('cashier.close')
+        # The lines are accounted with their sale
+        with Transaction().set_context(_cashier_close_sale_lines=False):
+            sales = super(Sale, cls).create(vlist)
+        Close.update_sale_cache({}, Close._get_sale_amounts(sales))
+        return sales
+
+    @classmethod
+    def write(cls, *args):
+        Close = Pool().get('cashier.close')
+        actions = iter(args)
+        sales = []
+        for sub_sales, values in zip(actions, actions):
+            # Only these fields change the sale amount of the close
+            if {'cashier_close', 'lines'} & set(values):
+                sales += sub_sales
+        before = Close._get_sale_amounts(sales)
+        with Transaction().set_context(_cashier_close_sale_lines=False):
+            super(Sale, cls).write(*args)
+        Close.update_sale_cache(before, Close._get_sale_amounts(sales))
+
+    @classmethod
+    def delete(cls, sales):
+        Close = Pool().get('cashier.close')
+        before = Close._get_sale_amounts(sales)
+        with Transaction().set_context(_cashier_close_sale_lines=False):
+            super(Sale, cls).delete(sales)
+        Close.update_sale_cache(before, {})
+
+
+class SaleLine(metaclass=PoolMeta):
+    __name__ = 'sale.line'
+
+    @classmethod
+    def _get_cashier_close_sales(cls, lines, vlist=None):
+        '''
+        Return the sales of lines and the sales set in the values of vlist
+        when the lines are not changed through their sale.
+        '''
+        Sale = Pool().get('sale.sale')
+        if not Transaction().context.get('_cashier_close_sale_lines', True):
+            return []
+        sales = [l.sale for l in lines if l.sale]
+        sales += Sale.browse([v['sale'] for v in vlist or [] if v.get('sale')])
+        return sales
+
+    @classmethod
+    def create(cls, vlist):
+        Close = Pool().get('cashier.close')
+        sales = cls._get_cashier_close_sales([], vlist)
+        before = Close._get_sale_amounts(sales)
+        lines = super(SaleLine, cls).create(vlist)
+        Close.update_sale_cache(before, Close._get_sale_amounts(sales))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        Close = Pool().get('cashier.close')
+        actions = iter(args)
+        lines, vlist = [], []
+        for sub_lines, values in zip(actions, actions):
+            lines += sub_lines
+            vlist.append(values)
+        sales = cls._get_cashier_close_sales(lines, vlist)
+        before = Close._get_sale_amounts(sales)
+        super(SaleLine, cls).write(*args)
+        Close.update_sale_cache(before, Close._get_sale_amounts(sales))
+
+    @classmethod
+    def delete(cls, lines):
+        Close = Pool().get('cashier.close')
+        sales = cls._get_cashier_close_sales(lines)
+        before = Close._get_sale_amounts(sales)
+        super(SaleLine, cls).delete(lines)
+        Close.update_sale_cache(before, Close._get_sale_amounts(sales))
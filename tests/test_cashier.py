@@ -24,9 +24,14 @@ class CashierTestCase(ModuleTestCase):
         ConfigCashBank = pool.get('cash_bank.configuration')
         Config = pool.get('cashier.configuration')
         Close = pool.get('cashier.close')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
         TerminalMove = pool.get('cashier.close.terminal.move')
         TerminalMoveType = pool.get('cashier.close.terminal.move.type')
         TerminalMoveAmount = pool.get('cashier.close.terminal.move.amount')
+        CollectedInAdvance = pool.get('cashier.close.advance')
+        CollectedInAdvanceApply = pool.get('cashier.close.advance.apply')
+        Advance = pool.get('cash_bank.advance')
 
         date = datetime.date.today()
         party = self._create_party('Sale Party', None, None)
@@ -139,11 +144,214 @@ class CashierTestCase(ModuleTestCase):
             self.assertEqual(close.terminal_amount, Decimal('100.0'))
             self.assertEqual(close.diff, Decimal('200.0'))
 
+            # Stored totals
+
+            self.assertEqual(close.sale_amount_cache, Decimal('300.0'))
+            self.assertEqual(close.terminal_amount_cache, Decimal('100.0'))
+            self.assertEqual(close.diff_cache, Decimal('200.0'))
+
+            sale_3 = self._create_sale(
+                date, party, product, Decimal('50.0'))
+            close_2 = Close(
+                cashier=cashier,
+                date=date,
+                sales=[sale_3],
+                terminals=[
+                    self._create_terminal_move(
+                        cashier.terminals[0], Decimal('100.0')),
+                    ],
+            )
+            close_2.save()
+            self.assertEqual(close_2.sale_amount_cache, Decimal('50.0'))
+            self.assertEqual(close_2.diff_cache, Decimal('-50.0'))
+
+            self.assertEqual(
+                Close.search([('diff', '=', Decimal('200.0'))]), [close])
+            self.assertEqual(
+                Close.search([('sale_amount', '<', Decimal('300.0'))]),
+                [close_2])
+            self.assertEqual(
+                Close.search([], order=[('diff', 'ASC')]), [close_2, close])
+            self.assertEqual(
+                Close.search([], order=[('sale_amount', 'DESC')]),
+                [close, close_2])
+
+            # Moving a sale updates the totals of both closes
+            Sale.write([sale_3], {'cashier_close': close.id})
+            self.assertEqual(close.sale_amount_cache, Decimal('350.0'))
+            self.assertEqual(close_2.sale_amount_cache, Decimal('0.0'))
+            Sale.write([sale_3], {'cashier_close': close_2.id})
+            self.assertEqual(close.sale_amount_cache, Decimal('300.0'))
+            self.assertEqual(close_2.sale_amount_cache, Decimal('50.0'))
+
+            # Changing a sale line updates the totals of the close
+            line, = sale_3.lines
+            SaleLine.write([line], {'unit_price': Decimal('70.0')})
+            self.assertEqual(close_2.sale_amount_cache, Decimal('70.0'))
+            self.assertEqual(close_2.diff_cache, Decimal('-30.0'))
+            SaleLine.write([line], {'unit_price': Decimal('50.0')})
+            self.assertEqual(close_2.diff_cache, Decimal('-50.0'))
+
+            # Changing a terminal amount updates the totals of its close
+            amount, = close_2.terminals[0].types[0].amounts
+            TerminalMoveAmount.write([amount], {'amount': Decimal('80.0')})
+            self.assertEqual(close_2.terminal_amount_cache, Decimal('80.0'))
+            self.assertEqual(close_2.diff_cache, Decimal('-30.0'))
+            TerminalMoveAmount.write([amount], {'amount': Decimal('100.0')})
+            self.assertEqual(close_2.diff_cache, Decimal('-50.0'))
+
+            # Consolidate receipt lines
+
+            def line(type_, amount, account):
+                return Close._get_receipt_line(
+                    type_, 'Line', amount, account, party, None)
+            kept = line('move_line', Decimal('3.0'), account_revenue)
+            sale_line = line(
+                'invoice_customer', Decimal('8.0'), account_expense)
+            lines = Close._consolidate_lines([
+                    line('move_line', Decimal('10.0'), account_expense),
+                    line('move_line', Decimal('7.0'), account_cash),
+                    kept,
+                    line('move_line', Decimal('5.0'), account_expense),
+                    line('move_line', Decimal('-7.0'), account_cash),
+                    sale_line,
+                    ], 'Merged')
+            self.assertEqual(len(lines), 3)
+            merged = lines[0]
+            self.assertEqual(merged.description, 'Merged')
+            self.assertEqual(merged.amount, Decimal('15.0'))
+            self.assertEqual(merged.account, account_expense)
+            self.assertEqual(merged.party, party)
+            self.assertIs(lines[1], kept)
+            self.assertIs(lines[2], sale_line)
+
+            # Net transfers
+
+            transfers = (
+                Close._get_terminal_transfers(
+                    close, close.terminals[0], {})
+                + Close._get_terminal_transfers(
+                    close_2, close_2.terminals[0], {}))
+            self.assertEqual(len(transfers), 2)
+            other, = Close._get_terminal_transfers(
+                close_2, close_2.terminals[0], {})
+            other.date = date + datetime.timedelta(days=1)
+            netted, kept = Close._get_net_transfers(transfers + [other])
+            self.assertIs(kept, other)
+            self.assertEqual(netted.cash, Decimal('200.0'))
+            self.assertEqual(netted.cashier_close, close)
+            self.assertEqual(list(netted.cashier_close_terminals),
+                [close.terminals[0], close_2.terminals[0]])
+
+            # The discounts of the netted terminals are merged by account
+            cash, lines = netted._get_cashier_close_receipt_lines(
+                account_cash)
+            self.assertEqual(cash, Decimal('200.0'))
+            self.assertEqual([(l.account, l.amount) for l in lines], [
+                    (account_expense, Decimal('-31.0')),
+                    (account_revenue, Decimal('31.0')),
+                    (account_cash, Decimal('200.0')),
+                    ])
+
+            # A netted transfer is listed under all the closes it covers
+            config.post_net_transfers = True
+            config.save()
+            summaries = Close.simulate_post([close, close_2])
+            self.assertEqual(
+                [len(s['transfers']) for s in summaries], [1, 1])
+            for summary in summaries:
+                self.assertEqual(
+                    summary['transfers'][0]['cash'], Decimal('200.0'))
+            config.post_net_transfers = False
+            config.save()
+
+            # Post groups: closes sharing a cashier or a cash
+
+            cash_2 = create_cash_bank(
+                company, 'Second Cash', 'cash',
+                journal, account_cash, cash_bank_seq
+            )
+            close_3 = Close(
+                cashier=self._create_cashier(cash, bank, account_expense),
+                date=date,
+            )
+            close_3.save()
+            close_4 = Close(
+                cashier=self._create_cashier(cash_2, bank, account_expense),
+                date=date,
+            )
+            close_4.save()
+            groups = Close._get_post_groups([close_4, close_3, close_2, close])
+            self.assertEqual(sorted(groups, key=len),
+                [[close_4], [close, close_2, close_3]])
+
+            # Simulate post, nothing is written
+            summary, = Close.simulate_post([close])
+            self.assertEqual(summary['close'], close.id)
+            self.assertEqual(summary['receipt']['cash'], Decimal('100.0'))
+            self.assertEqual(len(summary['receipt']['lines']), 3)
+            self.assertEqual(len(summary['transfers']), 1)
+            self.assertEqual(close.cash_bank_receipt, None)
+            self.assertEqual(len(close.transfers), 0)
+
             Close.confirm([close])
             Close.post([close])
 
             self.assertEqual(len(close.transfers), 1)
 
+            # Advance collected in a close and applied in another one
+
+            party_5 = self._create_party(
+                'Customer 5', account_receivable, account_payable)
+            close_5 = Close(
+                cashier=cashier,
+                date=date,
+                sales=[self._create_sale(
+                        date, party, product, Decimal('100.0'))],
+                terminals=[
+                    self._create_terminal_move(
+                        cashier.terminals[0], Decimal('140.0')),
+                    ],
+                collected_in_advance=[
+                    CollectedInAdvance(
+                        party=party_5,
+                        account=account_receivable,
+                        amount_collected=Decimal('40.0'),
+                    ),
+                    ],
+            )
+            close_5.save()
+            self.assertEqual(close_5.diff, Decimal('0.0'))
+            Close.confirm([close_5])
+            Close.post([close_5])
+            self.assertEqual(close_5.state, 'posted')
+
+            advance, = Advance.search([('party', '=', party_5.id)])
+            close_6 = Close(
+                cashier=cashier,
+                date=date,
+                sales=[self._create_sale(
+                        date, party, product, Decimal('60.0'))],
+                terminals=[
+                    self._create_terminal_move(
+                        cashier.terminals[0], Decimal('20.0')),
+                    ],
+                collected_in_advance_apply=[
+                    CollectedInAdvanceApply(
+                        party=party_5,
+                        advance=advance,
+                        amount_apply=Decimal('40.0'),
+                    ),
+                    ],
+            )
+            close_6.save()
+            self.assertEqual(close_6.diff, Decimal('0.0'))
+            summary, = Close.simulate_post([close_6])
+            self.assertEqual(summary['close'], close_6.id)
+            Close.confirm([close_6])
+            Close.post([close_6])
+            self.assertEqual(close_6.state, 'posted')
+
             return
 
             # Add documents (Usually cheques)
@@ -316,6 +524,27 @@ class CashierTestCase(ModuleTestCase):
             Close.confirm([close])
             Close.post([close])
 
+    def _create_terminal_move(self, terminal, amount):
+        pool = Pool()
+        TerminalMove = pool.get('cashier.close.terminal.move')
+        TerminalMoveType = pool.get('cashier.close.terminal.move.type')
+        TerminalMoveAmount = pool.get('cashier.close.terminal.move.amount')
+        move = TerminalMove(
+            terminal=terminal,
+            types=[
+                TerminalMoveType(
+                    type=terminal.money_types[0],
+                    amounts=[
+                        TerminalMoveAmount(
+                            amount_type=terminal.money_types[0].amounts[0],
+                            amount=amount,
+                        ),
+                        ]
+                    )
+                ],
+        )
+        return move
+
     def _create_customer_receivable(self, party, amount, payable=False):
         if payable:
             CR = Pool().get('cashier.close.customer_payable')
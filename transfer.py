@@ -1,6 +1,6 @@
 #This file is part of tryton-cashier project. The COPYRIGHT file at the top level of
 #this repository contains the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from trytond.model import fields
 from decimal import Decimal
 
@@ -14,52 +14,74 @@ class Transfer(metaclass=PoolMeta):
     cashier_close_moneytype = fields.Many2One(
         'cashier.close.terminal.move.type',
         'Cashier Close Terminal Money Type')
+    cashier_close_terminals = fields.One2Many(
+        'cashier.close.terminal.move', 'transfer',
+        'Cashier Close Net Terminals', readonly=True)
+
+    @classmethod
+    def copy(cls, transfers, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('cashier_close_terminals', None)
+        return super(Transfer, cls).copy(transfers, default=default)
 
     def _get_cashier_close_transfer_data(self, moneytype):
         cash = Decimal('0.0')
-        discounts = []
 
         if not moneytype.is_document:
             cash = moneytype.amount_total
 
-        discounts += self.cashier_close._get_discounts(
-                moneytype.type,
-                moneytype.amount_total,
-                self.cashier_close.currency.digits)
-
-        for mnt in moneytype.amounts:
-            discounts += self.cashier_close._get_discounts(
-                    mnt.amount_type,
-                    mnt.amount,
-                    self.cashier_close.currency.digits)
-
-        return cash, discounts 
-
-
-    def _create_receipt_to(self, cash_bank, type_, transfer_account, docs):
-        if not self.cashier_close_terminal:
-            return super(Transfer, self)._create_receipt(
-                cash_bank, self.cash, type_, transfer_account, docs)
+        discounts = self.cashier_close._get_moneytype_discounts(moneytype)
+        return cash, discounts
 
+    def _get_cashier_close_receipt_lines(self, transfer_account):
+        '''
+        Return the cash and the cash_bank.receipt.line (not saved) of the
+        receipt to of a transfer created by a cashier close.
+        '''
+        pool = Pool()
+        Config = pool.get('cashier.configuration')
+        config = Config(1)
         lines = []
         discounts = []
         close = self.cashier_close
         terminal = self.cashier_close_terminal
-        msg = '[' + close.rec_name + '-' + close.cashier.name + \
-                '][' + terminal.terminal.name + ']'
         total = Decimal('0.0')
         cash = Decimal('0.0')
 
-        if self.cashier_close_moneytype:  # No grouping
-            cash, discounts = self._get_cashier_close_transfer_data(
-                    self.cashier_close_moneytype)
-            total = self.cashier_close_moneytype.amount_total
+        if self.cashier_close_terminals:  # Netted
+            msg = self.description
+            cash_bank_account = self.cash_bank_to.account
+            by_account = {}
+            for terminal in self.cashier_close_terminals:
+                for moneytype in terminal.types:
+                    cs, disc = self._get_cashier_close_transfer_data(
+                        moneytype)
+                    cash += cs
+                    total += moneytype.amount_total
+                    for discount in disc:
+                        if discount[0] in by_account:
+                            by_account[discount[0]][1] += discount[1]
+                        else:
+                            by_account[discount[0]] = list(discount)
+            discounts = list(by_account.values())
         else:
-            for moneytype in terminal.types:
-                cs, disc = self._get_cashier_close_transfer_data(moneytype)
-                cash += cs
-                discounts += disc
-                total += moneytype.amount_total
+            msg = '[' + close.rec_name + '-' + close.cashier.name + \
+                    '][' + terminal.terminal.name + ']'
+            cash_bank_account = terminal.terminal.cash_bank.account
+            if self.cashier_close_moneytype:  # No grouping
+                cash, discounts = self._get_cashier_close_transfer_data(
+                    self.cashier_close_moneytype)
+                total = self.cashier_close_moneytype.amount_total
+            else:
+                for moneytype in terminal.types:
+                    cs, disc = self._get_cashier_close_transfer_data(
+                        moneytype)
+                    cash += cs
+                    discounts += disc
+                    total += moneytype.amount_total
 
         for discount in discounts:
             if discount[1] > 0:
@@ -78,7 +100,7 @@ class Transfer(metaclass=PoolMeta):
                         'move_line',
                         msg + discount[2],
                         discount[1],
-                        terminal.terminal.cash_bank.account,
+                        cash_bank_account,
                         close.company.party,
                         None
                     )
@@ -96,6 +118,18 @@ class Transfer(metaclass=PoolMeta):
                 )
             )
 
+        if config.post_consolidate_lines:
+            lines = close._consolidate_lines(lines, msg)
+        return cash, lines
+
+    def _create_receipt_to(self, cash_bank, type_, transfer_account, docs):
+        if (not self.cashier_close_terminal
+                and not self.cashier_close_terminals):
+            return super(Transfer, self)._create_receipt(
+                cash_bank, self.cash, type_, transfer_account, docs)
+
+        cash, lines = self._get_cashier_close_receipt_lines(transfer_account)
+
         receipt = self._new_receipt(cash_bank, cash, type_)
         receipt.documents = self._get_doc(receipt, docs)
         receipt.lines = lines 